@@ -1,9 +1,16 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes
 from config import ADMIN_ID
-from database import Database
+from database import Database, AsyncDatabase
+from broadcast import BroadcastManager, STATUS_TITLES, format_status, status_keyboard
+from delivery import DeliveryService
 
 db = Database()
+async_db = AsyncDatabase(db)
+broadcasts = BroadcastManager(async_db)
+# Доставка валентинок делит лимит скорости Telegram с рассылками
+deliveries = DeliveryService(async_db, broadcasts.broadcaster)
 
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Открыть панель администратора ИИ"""
@@ -20,11 +27,17 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    stats = db.get_stats()
+    stats = await async_db.get_stats()
+    throughput = await async_db.get_throughput(minutes=5)
+    user_cache = await async_db.get_user_cache_stats()
+    outbox = await async_db.get_outbox_stats()
+    latency = throughput['delivery_latency']
     
     keyboard = [
         [InlineKeyboardButton("📊 Статистика ПочтИИИ", callback_data="admin_stats")],
         [InlineKeyboardButton("📢 Отправить объявление", callback_data="admin_broadcast")],
+        [InlineKeyboardButton("📋 Рассылки", callback_data="admin_jobs")],
+        [InlineKeyboardButton("🔄 Пересчитать статистику", callback_data="admin_reconcile")],
         [InlineKeyboardButton("🔙 Вернуться", callback_data="admin_back")],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -34,13 +47,74 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"(Система Почты Института Искусственного Интеллекта)\n\n"
         f"📊 Статистика:\n"
         f"👥 Студентов в системе: {stats['total_users']}\n"
-        f"💌 Посланий доставлено: {stats['delivered']}\n"
-        f"📬 Ждет доставки: {stats['in_queue']}\n"
+        f"🚫 Недоступны для рассылок: {stats['blocked_users']}\n"
+        f"💌 Посланий доставлено: {stats['delivered'] + stats['archived']}\n"
+        f"📬 Ждет доставки: {stats['in_queue']}\n\n"
+        f"⚡ За последние {throughput['minutes']} мин:\n"
+        f"💌 Посланий: {throughput['sent']} ({throughput['sent_per_minute']:.1f}/мин)\n"
+        f"👥 Новых студентов: {throughput['new_users']} ({throughput['new_users_per_minute']:.1f}/мин)\n"
+        f"📨 Доставлено: {throughput['delivered']} ({throughput['delivered_per_minute']:.1f}/мин), "
+        f"задержка {f'{latency:.1f} с' if latency is not None else '—'}\n\n"
+        f"📤 Outbox: ждут {outbox['pending']} (отложено {outbox['scheduled']}, "
+        f"готовых картинок {outbox['prerendered']}), отправляются {outbox['sending']}, "
+        f"не доставлены {outbox['failed']}\n"
+        f"🗂 Кэш получателей: {user_cache['hit_rate']:.0%} попаданий "
+        f"({user_cache['hits']}/{user_cache['hits'] + user_cache['misses']})\n"
     )
     
     await query.edit_message_text(text=text, reply_markup=reply_markup)
 
 
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Полная статистика, включая архив"""
+    query = update.callback_query
+    await query.answer()
+    
+    if query.from_user.id != ADMIN_ID:
+        return
+    
+    stats = await async_db.get_stats()
+    archive = await async_db.get_archive_stats()
+    
+    text = (
+        f"📊 Статистика ПочтИИИ\n\n"
+        f"👥 Студентов в системе: {stats['total_users']}\n"
+        f"🚫 Недоступны для рассылок: {stats['blocked_users']}\n"
+        f"💌 Посланий доставлено: {stats['delivered'] + archive['archived']}\n"
+        f"   • в рабочей базе: {stats['delivered']}\n"
+        f"   • в архиве: {archive['archived']}\n"
+        f"📬 Ждет доставки: {stats['in_queue']}\n"
+    )
+    if archive['archived']:
+        text += f"\n🗄 Архив: с {archive['first_sent_at']} по {archive['last_sent_at']}\n"
+    
+    keyboard = [[InlineKeyboardButton("🔙 В панель", callback_data="admin_panel")]]
+    await query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def reconcile_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Пересчитать счетчики статистики по базе"""
+    query = update.callback_query
+    await query.answer()
+    
+    if query.from_user.id != ADMIN_ID:
+        return
+    
+    await async_db.reconcile_counters()
+    stats = await async_db.get_stats()
+    
+    keyboard = [[InlineKeyboardButton("🔙 В панель", callback_data="admin_panel")]]
+    await query.edit_message_text(
+        text=(
+            f"✅ Статистика пересчитана\n\n"
+            f"👥 Студентов в системе: {stats['total_users']}\n"
+            f"💌 Посланий доставлено: {stats['delivered'] + stats['archived']}\n"
+            f"📬 Ждет доставки: {stats['in_queue']}"
+        ),
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
 async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отправить объявление всем"""
     query = update.callback_query
@@ -76,36 +150,76 @@ async def process_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['waiting_broadcast'] = False
         return
     
-    # Получаем всех пользователей
-    users = db.get_all_users()
-    
-    success = 0
-    failed = 0
-    
     broadcast_text = (
         f"📢 Объявление от ПочтИИИ (Почта Института Искусственного Интеллекта):\n\n"
         f"{text}\n\n"
         f"🤖 Спасибо за использование нашего сервиса!"
     )
     
-    for user_id_to_send in users:
-        try:
-            await context.bot.send_message(chat_id=user_id_to_send, text=broadcast_text)
-            success += 1
-        except Exception as e:
-            print(f"Не удалось отправить пользователю {user_id_to_send}: {e}")
-            failed += 1
-    
-    await update.message.reply_text(
-        f"✅ Объявление распространено!\n\n"
-        f"📬 Доставлено студентам: {success}\n"
-        f"⚠️ Ошибок: {failed}\n\n"
-        f"Спасибо за работу в системе ПочтИИИ!"
-    )
+    # Рассылка идет в фоне и переживает перезапуск бота; это сообщение
+    # обновляется с прогрессом и содержит кнопки управления
+    status = await update.message.reply_text("📤 Рассылка запускается...")
+    broadcast_id = await broadcasts.create(broadcast_text, status.chat_id, status.message_id)
+    job = await broadcasts.status(broadcast_id)
+    await status.edit_text(format_status(job), reply_markup=status_keyboard(job))
     
     context.user_data['waiting_broadcast'] = False
 
 
+async def broadcast_control(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Пауза, продолжение, отмена и статус рассылки (bc_<действие>_<id>)"""
+    query = update.callback_query
+    
+    if query.from_user.id != ADMIN_ID:
+        await query.answer()
+        return
+    
+    _, action, broadcast_id = query.data.split("_")
+    broadcast_id = int(broadcast_id)
+    
+    if action == "pause":
+        changed = await broadcasts.pause(broadcast_id)
+    elif action == "resume":
+        changed = await broadcasts.resume(broadcast_id)
+    elif action == "cancel":
+        changed = await broadcasts.cancel(broadcast_id)
+    else:
+        changed = True
+    if changed:
+        await query.answer()
+    else:
+        await query.answer("Статус рассылки уже изменился")
+    
+    job = await broadcasts.status(broadcast_id)
+    if job is None:
+        await query.edit_message_text("❌ Рассылка не найдена")
+        return
+    try:
+        await query.edit_message_text(format_status(job), reply_markup=status_keyboard(job))
+    except BadRequest:
+        # Текст не изменился
+        pass
+
+
+async def admin_broadcasts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Список незавершенных рассылок"""
+    query = update.callback_query
+    await query.answer()
+    
+    if query.from_user.id != ADMIN_ID:
+        return
+    
+    jobs = await async_db.get_broadcasts(["running", "paused"])
+    keyboard = [
+        [InlineKeyboardButton(f"{STATUS_TITLES[job['status']]} #{job['id']}", callback_data=f"bc_status_{job['id']}")]
+        for job in jobs
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 В панель", callback_data="admin_panel")])
+    
+    text = "📋 Активные рассылки:" if jobs else "📋 Активных рассылок нет"
+    await query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
 async def admin_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Вернуться в главное меню"""
     query = update.callback_query
@@ -0,0 +1,40 @@
+"""
+Архивация старых валентинок
+
+Запуск: python archive_valentines.py [дней] [--full-vacuum]
+
+Переносит доставленные валентинки старше ARCHIVE_AFTER_DAYS дней (или
+указанного числа дней) в архивную базу ARCHIVE_DB_PATH, а затем небольшими
+шагами возвращает освободившееся место (incremental vacuum). Можно запускать
+при работающем боте, например раз в сутки из cron: каждая пачка переносится
+короткой транзакцией и не блокирует обработчики надолго.
+
+Базу, созданную до включения incremental vacuum, нужно один раз перевести
+полным VACUUM с флагом --full-vacuum. Он блокирует всю базу на время
+перезаписи, поэтому запускайте его при остановленном боте.
+"""
+import sys
+
+from config import ARCHIVE_AFTER_DAYS
+from database import Database
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    full_vacuum = "--full-vacuum" in sys.argv[1:]
+    days = int(args[0]) if args else ARCHIVE_AFTER_DAYS
+
+    db = Database()
+    moved = db.archive_delivered(older_than_days=days)
+    print(f"🗄 Перенесено в архив: {moved}")
+
+    pages = db.vacuum(allow_full=full_vacuum)
+    print(f"🧹 Освобождено страниц: {pages}")
+
+    archive = db.get_archive_stats()
+    print(f"📦 Всего в архиве: {archive['archived']}")
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
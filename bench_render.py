@@ -0,0 +1,154 @@
+"""
+Замер рендера посланий: время и память на одно послание
+
+Запуск: python bench_render.py [количество]
+
+Сравнивает текущий конвейер (кэш шаблонов, LUT-затемнение, подложка только
+по области эллипса, переиспользуемый холст) с прежним: открытие PNG, затемнение
+через RGBA-слой, 35 эллипсов на полноразмерном overlay, двойная конвертация
+RGB <-> RGBA и сохранение в PNG. Каждый вариант запускается в отдельном
+процессе, чтобы замеры памяти не смешивались.
+
+Пиковая память на одно послание - это прирост VmHWM над текущим RSS за один
+рендер (Linux: счетчик сбрасывается через /proc/self/clear_refs). Чтобы RSS
+отражал живые буферы Pillow, крупные выделения идут через mmap и сразу
+возвращаются системе (MALLOC_MMAP_THRESHOLD_).
+"""
+import os
+import resource
+import subprocess
+import sys
+import time
+from io import BytesIO
+from typing import Optional
+
+from PIL import Image, ImageDraw
+
+from utils2 import ImageProcessor
+
+TEXTS = [
+    "С днём святого Валентина!",
+    "Ты самый лучший человек на свете, спасибо что ты есть рядом со мной каждый день",
+    "Люблю тебя очень сильно и хочу быть рядом всегда-всегда. " * 3,
+]
+
+
+def peak_rss_mb() -> float:
+    """Пиковый RSS процесса за всё время в МБ"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает КБ, macOS - байты
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _proc_status_mb(field: str) -> float:
+    """Значение поля из /proc/self/status (VmRSS, VmHWM) в МБ"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    raise KeyError(field)
+
+
+def measure_peak(func, *args) -> Optional[float]:
+    """
+    Сколько памяти (МБ) сверх текущей занял вызов func на пике
+
+    Возвращает None, если система не позволяет сбросить пиковый RSS.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        before = _proc_status_mb("VmRSS")
+    except (OSError, KeyError):
+        func(*args)
+        return None
+
+    func(*args)
+    return _proc_status_mb("VmHWM") - before
+
+
+def legacy_render(template_id: int, text: str) -> bytes:
+    """Прежний конвейер рендера (для сравнения)"""
+    info = ImageProcessor.TEMPLATES[template_id]
+    img = Image.open(info.get("source", info["path"]))
+
+    dark_layer = Image.new('RGBA', img.size, (0, 0, 0, int(255 * 0.3)))
+    img = Image.alpha_composite(img.convert('RGBA'), dark_layer).convert('RGB')
+
+    layout = ImageProcessor.layout_text(template_id, text, img.width, img.height)
+    Image.new('RGB', img.size, (0, 0, 0))  # временный холст для textbbox
+
+    total_height = sum(layout.line_heights) + (len(layout.lines) - 1) * 15
+    text_width = layout.max_line_width + 100
+    text_height = total_height + 80
+    cx, cy = img.width // 2, img.height // 2
+    box = [cx - text_width // 2, cy - text_height // 2, cx + text_width // 2, cy + text_height // 2]
+
+    overlay = Image.new('RGBA', img.size, (0, 0, 0, 0))
+    ImageProcessor.blur_ellipse(ImageDraw.Draw(overlay), box, color=(0, 0, 0), alpha=180, blur_radius=35)
+    img = Image.alpha_composite(img.convert('RGBA'), overlay).convert('RGB')
+
+    draw = ImageDraw.Draw(img)
+    y = cy - total_height // 2
+    for line, width, height in zip(layout.lines, layout.line_widths, layout.line_heights):
+        draw.text((cx - width // 2, y), line, fill=(255, 255, 255), font=layout.font, anchor="lt")
+        y += height + 15
+
+    buffer = BytesIO()
+    img.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def current_render(template_id: int, text: str) -> bytes:
+    """Текущий конвейер рендера"""
+    result = ImageProcessor.create_valentine(template_id, text, in_memory=True)
+    if not result["success"]:
+        raise RuntimeError(result["error"])
+    return result["buffer"].getvalue()
+
+
+def run(mode: str, count: int):
+    """Замерить один вариант в текущем процессе и напечатать результат"""
+    render = legacy_render if mode == "legacy" else current_render
+    jobs = [(template_id, text) for template_id in ImageProcessor.TEMPLATES for text in TEXTS]
+
+    # Прогрев: кэши шаблонов, шрифтов и раскладок не входят в замер
+    for template_id, text in jobs:
+        render(template_id, text)
+
+    images_before = Image.core.get_stats()["new_count"]
+    started = time.perf_counter()
+
+    for i in range(count):
+        render(*jobs[i % len(jobs)])
+
+    elapsed = time.perf_counter() - started
+    images = Image.core.get_stats()["new_count"] - images_before
+
+    # Память замеряем отдельным проходом: сброс счетчика не должен влиять на время
+    peaks = [measure_peak(render, *job) for job in jobs]
+    if None in peaks:
+        memory = "пиковая память на послание недоступна"
+    else:
+        memory = f"пиковая память на послание {sum(peaks) / len(peaks):.1f} МБ (макс {max(peaks):.1f})"
+
+    print(
+        f"{mode:>8}: {elapsed / count * 1000:7.1f} мс/послание, "
+        f"{images / count:5.1f} изображений Pillow/послание, "
+        f"{memory}, пиковый RSS процесса {peak_rss_mb():.1f} МБ"
+    )
+
+
+def main():
+    if len(sys.argv) > 2:
+        run(sys.argv[2], int(sys.argv[1]))
+        return
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    env = dict(os.environ, MALLOC_MMAP_THRESHOLD_="131072")
+    for mode in ("legacy", "current"):
+        subprocess.run([sys.executable, __file__, str(count), mode], check=True, env=env)
+
+
+if __name__ == '__main__':
+    main()
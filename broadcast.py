@@ -0,0 +1,425 @@
+import asyncio
+import time
+from typing import Optional
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from config import (
+    BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_MAX_RETRIES, BROADCAST_CHAT_INTERVAL,
+    BROADCAST_PROGRESS_INTERVAL
+)
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    """RetryAfter.retry_after - число секунд или timedelta (в новых версиях PTB)"""
+    retry_after = error.retry_after
+    if hasattr(retry_after, "total_seconds"):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+# Ошибки BadRequest, после которых писать пользователю бесполезно
+DEAD_CHAT_ERRORS = ("chat not found", "user not found", "peer_id_invalid", "chat_id is empty")
+
+
+def classify_error(error: Exception):
+    """
+    Причина неудачной отправки: (вид, насовсем ли пользователь недоступен)
+
+    Вид None - ошибка не связана с получателем (сеть, лимиты Telegram) и не
+    учитывается в его счетчике неудач.
+    """
+    if isinstance(error, Forbidden):
+        # Бот заблокирован, аккаунт удален, пользователь не запускал бота
+        return "blocked", True
+    if isinstance(error, BadRequest):
+        if any(text in str(error).lower() for text in DEAD_CHAT_ERRORS):
+            return "not_found", True
+        return "bad_request", False
+    if isinstance(error, (RetryAfter, NetworkError)):
+        return None, False
+    return "error", False
+
+
+async def record_delivery(async_db, user_id: int, error: Optional[Exception]):
+    """Сохранить результат отправки в users (last_error, blocked, неудачи подряд)"""
+    if error is None:
+        await async_db.record_delivery(user_id)
+        return
+
+    kind, permanent = classify_error(error)
+    if kind is not None:
+        await async_db.record_delivery(user_id, f"{kind}: {error}", permanent)
+
+
+class TokenBucket:
+    """
+    Общий лимит скорости отправки: не больше rate сообщений в секунду
+
+    burst - сколько сообщений можно отправить подряд без пауз. По умолчанию 1:
+    сообщения идут ровно через 1/rate секунд, без всплесков, за которые
+    Telegram дает flood-бан.
+    """
+
+    def __init__(self, rate: float = BROADCAST_RATE, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    def pause(self, seconds: float):
+        """Остановить отправку на seconds секунд (после RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        """Дождаться разрешения на отправку одного сообщения"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        # Ждущие получают разрешения строго по очереди
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ChatLimiter:
+    """Не чаще одного сообщения в один чат за interval секунд"""
+
+    def __init__(self, interval: float = BROADCAST_CHAT_INTERVAL):
+        self.interval = interval
+        self._next = {}  # chat_id -> когда можно писать в чат
+
+    async def wait(self, chat_id: int):
+        now = time.monotonic()
+        ready = self._next.get(chat_id, now)
+        self._next[chat_id] = max(ready, now) + self.interval
+
+        # Забываем чаты, в которые уже можно писать, чтобы словарь не рос
+        if len(self._next) > 10000:
+            self._next = {chat: at for chat, at in self._next.items() if at > now}
+
+        if ready > now:
+            await asyncio.sleep(ready - now)
+
+
+class Broadcaster:
+    """
+    Массовая отправка сообщений в пределах лимитов Telegram
+
+    Одновременно выполняется не больше concurrency отправок. Все они проходят
+    через общий TokenBucket (rate сообщений в секунду) и ChatLimiter. На RetryAfter
+    отправка приостанавливается для всех на указанное Telegram время, сетевые
+    ошибки повторяются с нарастающей паузой. Forbidden и BadRequest (бот
+    заблокирован, чат не найден) не повторяются.
+    """
+
+    def __init__(self, rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY,
+                 max_retries: int = BROADCAST_MAX_RETRIES, chat_interval: float = BROADCAST_CHAT_INTERVAL):
+        self.bucket = TokenBucket(rate)
+        self.chats = ChatLimiter(chat_interval)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+
+    async def send(self, chat_id: int, send_func) -> Optional[Exception]:
+        """
+        Отправить одно сообщение: send_func(chat_id) - корутина отправки
+
+        Returns:
+            None, если сообщение отправлено, иначе последняя ошибка
+        """
+        attempt = 0
+        while True:
+            await self.chats.wait(chat_id)
+            await self.bucket.acquire()
+            try:
+                await send_func(chat_id)
+                return None
+            except RetryAfter as e:
+                # Лимит превышен для всего бота: ждем все вместе и повторяем
+                delay = _retry_after_seconds(e)
+                print(f"⏳ Telegram просит подождать {delay:.0f} с")
+                self.bucket.pause(delay)
+                # Таких повторов допускаем больше, чем при сетевых ошибках, но не бесконечно
+                if attempt > self.max_retries * 3:
+                    return e
+                attempt += 1
+            except (Forbidden, BadRequest) as e:
+                return e
+            except NetworkError as e:
+                # TimedOut тоже сюда: сообщение могло дойти, повтор может его задублировать
+                if attempt >= self.max_retries:
+                    return e
+                attempt += 1
+                await asyncio.sleep(min(2 ** attempt, 30))
+            except Exception as e:
+                return e
+
+    async def run(self, chat_ids, send_func, on_result=None, on_progress=None,
+                  progress_interval: float = BROADCAST_PROGRESS_INTERVAL) -> dict:
+        """
+        Отправить сообщение всем chat_ids (обычный или асинхронный итератор)
+
+        Args:
+            send_func: корутина отправки одному чату, send_func(chat_id)
+            on_result: корутина on_result(chat_id, error) после каждой отправки
+                (error - None при успехе)
+            on_progress: корутина on_progress(stats), вызывается не чаще раза
+                в progress_interval секунд и в конце
+
+        Returns:
+            {"sent", "failed", "elapsed", "rate"}
+        """
+        stats = {"sent": 0, "failed": 0, "elapsed": 0.0, "rate": 0.0}
+        started = time.monotonic()
+        last_progress = started
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def report(force: bool = False):
+            nonlocal last_progress
+            now = time.monotonic()
+            stats["elapsed"] = now - started
+            stats["rate"] = (stats["sent"] + stats["failed"]) / stats["elapsed"] if stats["elapsed"] else 0.0
+            if on_progress and (force or now - last_progress >= progress_interval):
+                last_progress = now
+                try:
+                    await on_progress(dict(stats))
+                except Exception as e:
+                    print(f"Не удалось обновить прогресс рассылки: {e}")
+
+        async def worker():
+            while True:
+                chat_id = await queue.get()
+                try:
+                    error = await self.send(chat_id, send_func)
+                    if error is None:
+                        stats["sent"] += 1
+                    else:
+                        stats["failed"] += 1
+                        print(f"Не удалось отправить пользователю {chat_id}: {error}")
+                    if on_result:
+                        try:
+                            await on_result(chat_id, error)
+                        except Exception as e:
+                            print(f"Ошибка обработки результата рассылки для {chat_id}: {e}")
+                    await report()
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            if hasattr(chat_ids, "__aiter__"):
+                async for chat_id in chat_ids:
+                    await queue.put(chat_id)
+            else:
+                for chat_id in chat_ids:
+                    await queue.put(chat_id)
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        await report(force=True)
+        return stats
+
+
+STATUS_TITLES = {
+    "running": "📤 Идет рассылка",
+    "paused": "⏸ Рассылка на паузе",
+    "cancelled": "✖️ Рассылка отменена",
+    "done": "✅ Рассылка завершена",
+}
+
+
+def format_status(job: dict, counted: Optional[dict] = None, rate: Optional[float] = None) -> str:
+    """Текст статуса рассылки для администратора"""
+    counted = counted or job
+    done = counted["sent"] + counted["failed"]
+    text = (
+        f"{STATUS_TITLES.get(job['status'], job['status'])} #{job['id']}\n\n"
+        f"📬 Доставлено: {counted['sent']}\n"
+        f"⚠️ Ошибок: {counted['failed']}\n"
+        f"👥 Обработано: {done} из ~{job['total'] or '?'}\n"
+    )
+    if rate and job["status"] == "running":
+        text += f"⚡ {rate:.1f} сообщений/с\n"
+    return text
+
+
+def status_keyboard(job: dict) -> Optional[InlineKeyboardMarkup]:
+    """Кнопки управления рассылкой в зависимости от статуса"""
+    broadcast_id = job["id"]
+    buttons = []
+    if job["status"] == "running":
+        buttons.append(InlineKeyboardButton("⏸ Пауза", callback_data=f"bc_pause_{broadcast_id}"))
+    elif job["status"] == "paused":
+        buttons.append(InlineKeyboardButton("▶️ Продолжить", callback_data=f"bc_resume_{broadcast_id}"))
+    if job["status"] in ("running", "paused"):
+        buttons.append(InlineKeyboardButton("✖️ Отменить", callback_data=f"bc_cancel_{broadcast_id}"))
+    buttons.append(InlineKeyboardButton("🔄 Статус", callback_data=f"bc_status_{broadcast_id}"))
+    return InlineKeyboardMarkup([buttons])
+
+
+class BroadcastManager:
+    """
+    Фоновые рассылки, которые переживают перезапуск бота
+
+    Рассылка хранится в таблице broadcasts: текст, статус и курсор - все
+    пользователи с user_id <= cursor уже обработаны. Отправки идут параллельно и
+    завершаются не по порядку, поэтому кому отправлено после курсора, хранится в
+    broadcast_deliveries. После перезапуска рассылки в статусе running
+    продолжаются с курсора без повторных сообщений (кроме тех, что были в пути
+    в момент падения).
+    """
+
+    def __init__(self, async_db, broadcaster: Optional[Broadcaster] = None):
+        self.db = async_db
+        # Один Broadcaster на все рассылки: общий лимит скорости на весь бот
+        self.broadcaster = broadcaster or Broadcaster()
+        self.bot = None
+        self._tasks = {}  # broadcast_id -> asyncio.Task
+        self._stopping = set()
+
+    async def start(self, bot):
+        """Продолжить незавершенные рассылки (при старте бота)"""
+        self.bot = bot
+        for job in await self.db.get_broadcasts(["running"]):
+            print(f"📢 Продолжаем рассылку #{job['id']} с пользователя {job['cursor']}")
+            self._spawn(job["id"])
+
+    async def stop(self):
+        """Остановить задачи при выключении бота (статус running сохраняется)"""
+        self._stopping.update(self._tasks)
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    async def create(self, text: str, admin_chat_id: int, status_message_id: int) -> int:
+        """Создать рассылку и сразу запустить её в фоне"""
+        total = await self.db.estimate_users()
+        broadcast_id = await self.db.create_broadcast(text, admin_chat_id, status_message_id, total)
+        self._spawn(broadcast_id)
+        return broadcast_id
+
+    async def pause(self, broadcast_id: int) -> bool:
+        paused = await self.db.set_broadcast_status(broadcast_id, "paused", only_from=["running"])
+        if paused:
+            self._stopping.add(broadcast_id)
+        return paused
+
+    async def resume(self, broadcast_id: int) -> bool:
+        resumed = await self.db.set_broadcast_status(broadcast_id, "running", only_from=["paused"])
+        if resumed:
+            self._spawn(broadcast_id)
+        return resumed
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        cancelled = await self.db.set_broadcast_status(broadcast_id, "cancelled", only_from=["running", "paused"])
+        if cancelled:
+            self._stopping.add(broadcast_id)
+        return cancelled
+
+    async def status(self, broadcast_id: int) -> Optional[dict]:
+        return await self.db.get_broadcast(broadcast_id)
+
+    def _spawn(self, broadcast_id: int):
+        previous = self._tasks.get(broadcast_id)
+        task = asyncio.create_task(self._run(broadcast_id, previous))
+        self._tasks[broadcast_id] = task
+
+        def forget(_):
+            if self._tasks.get(broadcast_id) is task:
+                del self._tasks[broadcast_id]
+
+        task.add_done_callback(forget)
+
+    async def _run(self, broadcast_id: int, previous: Optional[asyncio.Task] = None):
+        # После быстрой паузы и продолжения ждем, пока прежняя задача дошлет начатое
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+
+        job = await self.db.get_broadcast(broadcast_id)
+        if job is None or job["status"] != "running":
+            return
+
+        done_after = await self.db.get_broadcast_done_after(broadcast_id, job["cursor"])
+        in_flight = {}  # user_id -> обработан ли (по порядку выдачи, т.е. по возрастанию user_id)
+        cursor = job["cursor"]
+        counted = {"sent": job["sent"], "failed": job["failed"]}
+
+        async def recipients():
+            async for user_id in self.db.iter_users(after_id=job["cursor"]):
+                if broadcast_id in self._stopping:
+                    return
+                if user_id in done_after:
+                    continue
+                in_flight[user_id] = False
+                yield user_id
+
+        async def send(chat_id):
+            await self.bot.send_message(chat_id=chat_id, text=job["text"])
+
+        async def on_result(chat_id, error):
+            nonlocal cursor
+            await self.db.record_broadcast_result(broadcast_id, chat_id, error is None)
+            await record_delivery(self.db, chat_id, error)
+            counted["sent" if error is None else "failed"] += 1
+            in_flight[chat_id] = True
+            # Курсор двигается до первого еще не обработанного получателя
+            for user_id in list(in_flight):
+                if not in_flight[user_id]:
+                    break
+                cursor = user_id
+                del in_flight[user_id]
+
+        async def on_progress(progress):
+            await self.db.advance_broadcast_cursor(broadcast_id, cursor)
+            # После паузы или отмены не перерисовываем статус администратора как "идет"
+            if broadcast_id in self._stopping:
+                return
+            current = await self.db.get_broadcast(broadcast_id)
+            if current is None or current["status"] != "running" or broadcast_id in self._stopping:
+                return
+            await self._show(current, counted, progress["rate"])
+
+        try:
+            result = await self.broadcaster.run(recipients(), send, on_result=on_result, on_progress=on_progress)
+        except Exception as e:
+            print(f"❌ Рассылка #{broadcast_id} прервана: {e}")
+            return
+        finally:
+            stopped = broadcast_id in self._stopping
+            self._stopping.discard(broadcast_id)
+
+        if not stopped:
+            await self.db.set_broadcast_status(broadcast_id, "done", only_from=["running"])
+
+        job = await self.db.get_broadcast(broadcast_id)
+        await self._show(job, counted, result["rate"])
+
+    async def _show(self, job: dict, counted: dict, rate: float):
+        """Обновить сообщение администратора с прогрессом рассылки"""
+        if not job.get("admin_chat_id") or not job.get("status_message_id"):
+            return
+        try:
+            await self.bot.edit_message_text(
+                chat_id=job["admin_chat_id"],
+                message_id=job["status_message_id"],
+                text=format_status(job, counted, rate),
+                reply_markup=status_keyboard(job),
+            )
+        except BadRequest as e:
+            # "message is not modified" и подобные - не повод останавливать рассылку
+            print(f"Не удалось обновить статус рассылки #{job['id']}: {e}")
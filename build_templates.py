@@ -0,0 +1,128 @@
+"""
+Сборка шаблонов посланий
+
+Запуск: python build_templates.py
+
+Для каждого templates/template<N>.png сохраняет уже затемнённые пиксели
+в сыром виде (их можно отобразить в память без декодирования PNG) и пишет
+манифест с областью под текст и таблицей размеров шрифта по длине текста.
+Бот загружает манифест один раз при старте (ImageProcessor.load_manifest),
+поэтому новый шаблон - это новый файл в templates/ и повторная сборка.
+"""
+import json
+import os
+import re
+
+from PIL import Image
+
+from config import TEMPLATES_PATH, FONTS_PATH, MAX_TEXT_LENGTH, TEMPLATES_MANIFEST
+from utils2 import ImageProcessor, FontMetrics
+
+# Символы, для которых считается таблица размеров шрифта.
+# Текст с другими символами подбирается обычным поиском.
+CHARSET = (
+    " !\"#$%&'()*+,-./0123456789:;<=>?@"
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_`abcdefghijklmnopqrstuvwxyz{|}~"
+    "АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯабвгдеёжзийклмнопрстуфхцчшщъыьэюя"
+    "«»—–…№"
+)
+
+# Размеры шрифта, которые перебирает ImageProcessor.calculate_optimal_font_size
+FONT_SIZES = list(range(60, 20, -2))
+
+
+def guaranteed_font_sizes(area_width: int, area_height: int) -> list:
+    """
+    Таблица: длина текста -> самый крупный размер шрифта, которым гарантированно
+    помещается любой текст такой длины из символов CHARSET (None - такого нет)
+
+    Оценка сверху: каждая строка не длиннее всего текста, каждый символ не шире
+    самого широкого глифа, строк не больше 4 и каждая не выше самого высокого глифа.
+    Проверки те же, что в ImageProcessor._font_fits.
+    """
+    max_width = area_width - 40
+    max_height = area_height - 40
+
+    # Для каждого размера - сколько символов точно помещается в строку
+    capacity = {}
+    for size in FONT_SIZES:
+        metrics = FontMetrics.of(ImageProcessor.get_font(size))
+        glyphs = [metrics.glyph(c) for c in CHARSET]
+
+        max_advance = max(g[0] for g in glyphs)
+        overhang = max(0, max(g[3] - g[0] for g in glyphs)) + max(0, -min(g[1] for g in glyphs))
+        line_height = max(g[4] for g in glyphs) - min(g[2] for g in glyphs)
+
+        if 4 * (line_height + 10) > max_height:
+            capacity[size] = -1
+        else:
+            capacity[size] = int((max_width - overhang) // max_advance)
+
+    table = []
+    for length in range(MAX_TEXT_LENGTH + 1):
+        fitting = [size for size in FONT_SIZES if capacity[size] >= length]
+        table.append(fitting[0] if fitting else None)
+    return table
+
+
+def build(manifest_path: str = TEMPLATES_MANIFEST):
+    """Собрать все шаблоны из TEMPLATES_PATH и записать манифест"""
+    out_dir = os.path.dirname(manifest_path)
+    os.makedirs(out_dir, exist_ok=True)
+
+    darkness_level = ImageProcessor.template_cache.darkness_level
+    templates = []
+    tables = {}
+
+    for name in sorted(os.listdir(TEMPLATES_PATH)):
+        match = re.fullmatch(r"template(\d+)\.png", name)
+        if not match:
+            continue
+
+        template_id = int(match.group(1))
+        source = f"{TEMPLATES_PATH}/{name}"
+
+        with Image.open(source) as src:
+            src.load()
+            img = ImageProcessor.darken_image(src, darkness_level=darkness_level)
+
+        # Сырые пиксели пишем во временный файл и подменяем атомарно
+        asset = f"template{template_id}.{img.mode.lower()}"
+        asset_path = os.path.join(out_dir, asset)
+        with open(asset_path + ".tmp", "wb") as f:
+            f.write(img.tobytes())
+        os.replace(asset_path + ".tmp", asset_path)
+
+        area = ImageProcessor.default_text_area(img.width, img.height)
+        area_size = (area[2] - area[0], area[3] - area[1])
+        if area_size not in tables:
+            tables[area_size] = guaranteed_font_sizes(*area_size)
+
+        templates.append({
+            "id": template_id,
+            "source": source,
+            "source_mtime": os.stat(source).st_mtime,
+            "asset": asset,
+            "mode": img.mode,
+            "size": list(img.size),
+            "text_area": list(area),
+            "min_font_sizes": tables[area_size],
+        })
+        print(f"✅ Шаблон #{template_id}: {source} -> {asset_path}")
+
+    manifest = {
+        "version": 1,
+        "darkness_level": darkness_level,
+        "font": {"path": FONTS_PATH, "mtime": os.stat(FONTS_PATH).st_mtime},
+        "charset": CHARSET,
+        "templates": templates,
+    }
+
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    print(f"📄 Манифест: {manifest_path} (шаблонов: {len(templates)})")
+
+
+if __name__ == '__main__':
+    build()
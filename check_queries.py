@@ -0,0 +1,183 @@
+"""
+Проверка планов запросов к базе
+
+Запуск: python check_queries.py
+
+Создает временную базу, вызывает каждый публичный метод Database и для
+каждого выполненного запроса печатает EXPLAIN QUERY PLAN - для того же
+текста с ? и тех же параметров, что выполняет бот. Завершается с ошибкой, если какой-то запрос читает таблицу целиком (любой SCAN, в том
+числе по индексу) или если для нового метода Database здесь нет вызова.
+"""
+import inspect
+import os
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+from database import ConnectionManager, Database
+
+# Служебные команды, у которых нет плана запроса
+SKIP_PREFIXES = ("BEGIN", "COMMIT", "ROLLBACK", "PRAGMA", "CREATE", "ALTER", "DROP", "ATTACH", "DETACH")
+
+# Методы, которые не обращаются к базе сами по себе
+SKIP_METHODS = {"close", "flush", "init_db", "vacuum"}
+
+# Методы, которым разрешено читать таблицы целиком: редкие служебные операции
+# и get_all_users, который по смыслу отдает всех пользователей
+# (для рассылок есть постраничный iter_users)
+FULL_SCAN_METHODS = {"reconcile_counters", "get_archive_stats", "get_all_users"}
+
+# Выполненные запросы: (метод Database, sql, параметры)
+statements = []
+# Стек вызванных методов Database
+called = []
+
+
+class RecordingConnection(sqlite3.Connection):
+    """Соединение, которое запоминает каждый запрос вместе с параметрами"""
+
+    def execute(self, sql, parameters=(), /):
+        statements.append((called[-1] if called else None, sql, parameters))
+        return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        rows = list(seq_of_parameters)
+        if rows:
+            statements.append((called[-1] if called else None, sql, rows[0]))
+        return super().executemany(sql, rows)
+
+
+def exercise(db: Database):
+    """Вызвать все методы Database на тестовых данных"""
+    db.add_user(1, "alice", "Alice")
+    db.add_user(2, "bob", "Bob", "B")
+    db.get_user_by_username("alice")
+    db.get_user_by_username("@Alice")
+    db.resolve_usernames(["Alice", "bob", "nobody"])
+    db.get_user_cache_stats()
+    db.add_user(2, "robert", "Bob", "B")
+    db.save_valentine(1, 2, "bob", "Привет", 1, True)
+    db.queue_valentine(1, "carol", "Привет", 2, False)
+    db.get_queued_valentines("carol")
+    claimed = db.claim_queued("carol", limit=10)
+    db.requeue_queued([item["id"] for item in claimed])
+    claimed = db.claim_queued("carol", limit=10)
+    db.ack_queued([item["id"] for item in claimed])
+    db.queue_valentine(1, "carol", "Еще раз", 2, False)
+    db.remove_from_queue(1)
+    outbox_id = db.enqueue_valentine(1, 2, "robert", "Через outbox", None, False)
+    db.enqueue_valentine(1, 2, "robert", "С картинкой", 1, True)
+    claimed = db.claim_outbox(limit=10)
+    db.touch_claim(outbox_id, claimed[0]["claim_token"])
+    db.mark_failed(outbox_id, claimed[0]["claim_token"], "network: timeout", retry_in=0)
+    db.mark_failed(claimed[-1]["id"], claimed[-1]["claim_token"], "blocked: Forbidden")
+    claimed = db.claim_outbox(limit=10, claim_timeout=0)
+    db.mark_delivered(outbox_id, claimed[0]["claim_token"])
+    db.get_outbox_stats()
+    scheduled_id = db.enqueue_valentine(1, 2, "robert", "К полуночи", 1, False,
+                                        release_at=datetime.utcnow() + timedelta(days=1))
+    db.get_prerender_batch(limit=10)
+    db.set_rendered_path(scheduled_id, "prerendered/valentine.jpg")
+    db.save_file_id("media-key", "file-id-1")
+    db.save_file_id("media-key", "file-id-2")
+    db.get_file_id("media-key")
+    db.forget_file_id("media-key")
+    db.get_stats()
+    db.get_throughput(minutes=5)
+    db.reconcile_counters()
+    db.prune_counter_buckets()
+    db.get_all_users()
+    db.get_all_users(include_blocked=True)
+    db.record_delivery(2, "blocked: Forbidden", permanent=True)
+    db.record_delivery(1, "error: timeout")
+    db.record_delivery(1)
+    db.add_user(2, "robert", "Bob", "B")
+    # Доставленная давно валентинка, чтобы архивации было что переносить
+    broadcast_id = db.create_broadcast("Объявление", 1, 1, total=2)
+    db.get_broadcasts(["running", "paused"])
+    db.record_broadcast_result(broadcast_id, 1, True)
+    db.record_broadcast_result(broadcast_id, 2, False)
+    db.get_broadcast_done_after(broadcast_id, 0)
+    db.advance_broadcast_cursor(broadcast_id, 1)
+    db.set_broadcast_status(broadcast_id, "paused", only_from=["running"])
+    db.get_broadcast(broadcast_id)
+    with db.connections.get() as conn:
+        conn.execute("UPDATE valentines SET delivered = 1, sent_at = '2000-01-01' WHERE id = 1")
+    db.archive_delivered(older_than_days=0, batch_size=10)
+    db.get_archive_stats()
+    list(db.iter_users(page_size=1))
+    db.get_users_page(after_id=1, limit=10, active_since=datetime.utcnow(), exclude_blocked=False)
+    db.estimate_users()
+    db.estimate_users(active_since=datetime.utcnow())
+
+
+def public_methods() -> set:
+    return {
+        name for name, _ in inspect.getmembers(Database, inspect.isfunction)
+        if not name.startswith("_") and name not in SKIP_METHODS
+    }
+
+
+def main() -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        ConnectionManager.factory = RecordingConnection
+        db = Database(os.path.join(tmp, "check.db"), write_behind=False,
+                      archive_path=os.path.join(tmp, "archive.db"))
+        conn = db.connections.get()
+        # Запросы миграций и init_db не проверяем
+        statements.clear()
+
+        for name in public_methods():
+            method = getattr(db, name)
+
+            def record(*args, _name=name, _method=method, **kwargs):
+                called.append(_name)
+                return _method(*args, **kwargs)
+
+            setattr(db, name, record)
+
+        exercise(db)
+        checked = list(statements)
+
+        failed = False
+        missing = public_methods() - set(called)
+        for name in sorted(missing):
+            print(f"❌ Database.{name} не вызывается в check_queries.exercise")
+            failed = True
+
+        # Для планов запросов к архиву
+        db._attach_archive(conn)
+
+        seen = set()
+        for method, sql, parameters in checked:
+            sql = " ".join(sql.split())
+            if sql.upper().startswith(SKIP_PREFIXES) or sql in seen:
+                continue
+            seen.add(sql)
+
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", parameters)]
+            # SCAN ... USING (COVERING) INDEX - это тоже проход по всей таблице (по индексу);
+            # допустим только SEARCH. SCAN (subquery-N) - проход по результату
+            # подзапроса, а не по таблице
+            scans = [step for step in plan if step.startswith("SCAN") and not step.startswith("SCAN (subquery")]
+            if method in FULL_SCAN_METHODS:
+                scans = []
+
+            print(("❌ " if scans else "✅ ") + sql)
+            for step in plan:
+                print(f"     {step}")
+            failed = failed or bool(scans)
+
+        conn.execute("DETACH DATABASE archive")
+        db.close()
+
+    if failed:
+        print("❌ Есть запросы без индекса")
+        return 1
+    print("✅ Все запросы используют индексы")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,2 +1,105 @@
 # Added SPOILER_VALENTINE setting
-SPOILER_VALENTINE = '2026-02-14 00:06:13'
\ No newline at end of file
+SPOILER_VALENTINE = '2026-02-14 00:06:13'
+
+# Лимит памяти для кэша затемнённых шаблонов (МБ)
+TEMPLATE_CACHE_MAX_MB = 64
+
+# Сколько раскладок текста (шаблон + текст) держать в памяти
+LAYOUT_CACHE_SIZE = 1024
+
+# Формат готовых картинок: "JPEG", "WEBP" или "PNG"
+RENDER_FORMAT = "JPEG"
+# Качество JPEG/WEBP (1-100)
+RENDER_QUALITY = 90
+# Уровень сжатия PNG (0-9): 1 - быстро, 9 - компактно
+RENDER_PNG_COMPRESS_LEVEL = 1
+
+# Пул процессов для рендера картинок: количество воркеров (0 - по числу ядер)
+RENDER_WORKERS = 0
+# Сколько задач рендера может ждать в очереди одновременно
+RENDER_QUEUE_SIZE = 64
+# Таймаут одной задачи рендера (секунды)
+RENDER_TIMEOUT = 30
+# render_service.render_many: сколько посланий одного шаблона рисуется одной задачей пула
+RENDER_BATCH_SIZE = 8
+
+# Превью при выборе шаблона: длинная сторона (px) и качество JPEG
+PREVIEW_MAX_SIDE = 512
+PREVIEW_QUALITY = 60
+# Текст на общем превью шаблона (одна картинка на шаблон, отправляется по file_id)
+PREVIEW_TEXT = "С Днём святого Валентина!"
+
+# Манифест собранных шаблонов (создается командой python build_templates.py)
+TEMPLATES_MANIFEST = "templates/compiled/manifest.json"
+
+# Асинхронный доступ к базе: потоки для чтения, размер очереди запросов, таймаут чтения (секунды)
+DB_READ_WORKERS = 4
+DB_QUEUE_SIZE = 256
+DB_TIMEOUT = 10
+
+# Отложенная запись add_user/save_valentine: строки пишутся пачкой раз в
+# DB_WRITE_BEHIND_MS мс или по DB_WRITE_BEHIND_ROWS строк. При падении теряется
+# не больше одного интервала. DB_WRITE_BEHIND_SYNCHRONOUS: "NORMAL" или "FULL"
+DB_WRITE_BEHIND = False
+DB_WRITE_BEHIND_MS = 200
+DB_WRITE_BEHIND_ROWS = 500
+DB_WRITE_BEHIND_SYNCHRONOUS = "NORMAL"
+
+# Через сколько секунд неподтвержденная выдача из очереди (claim_queued)
+# снова становится доступна для доставки
+QUEUE_CLAIM_TIMEOUT = 300
+
+# Сколько минут хранить поминутную статистику (counter_buckets)
+COUNTER_BUCKETS_KEEP_MINUTES = 24 * 60
+
+# Сколько пользователей читать из базы за один запрос при рассылке
+USERS_PAGE_SIZE = 500
+
+# Кэш username -> пользователь: сколько записей держать и сколько секунд
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300
+
+# Архив доставленных валентинок: отдельная база, куда archive_valentines.py
+# переносит строки старше ARCHIVE_AFTER_DAYS дней пачками по ARCHIVE_BATCH_SIZE
+ARCHIVE_DB_PATH = "valentine_archive.db"
+ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_BATCH_SIZE = 500
+
+# Инкрементальный VACUUM: страниц за шаг и максимум шагов за запуск
+VACUUM_STEP_PAGES = 256
+VACUUM_MAX_STEPS = 400
+
+# Рассылки: не больше BROADCAST_RATE сообщений в секунду на весь бот
+# (лимит Telegram ~30/с), одновременно до BROADCAST_CONCURRENCY отправок,
+# в один чат не чаще раза в BROADCAST_CHAT_INTERVAL секунд
+BROADCAST_RATE = 25
+BROADCAST_CONCURRENCY = 10
+BROADCAST_MAX_RETRIES = 3
+BROADCAST_CHAT_INTERVAL = 1.0
+# Как часто (в секундах) обновлять сообщение с прогрессом рассылки
+BROADCAST_PROGRESS_INTERVAL = 3
+
+# После скольких неудачных отправок подряд пользователь считается недоступным
+# и пропускается в рассылках (до следующего /start)
+DELIVERY_MAX_FAILURES = 5
+
+# Фоновая доставка валентинок (outbox): число воркеров, размер пачки,
+# пауза между проверками пустого outbox (с) и через сколько секунд
+# незавершенная отправка, не подтвержденная воркером (touch_claim), снова берется в работу
+DELIVERY_WORKERS = 4
+DELIVERY_BATCH_SIZE = 20
+DELIVERY_POLL_INTERVAL = 1.0
+OUTBOX_CLAIM_TIMEOUT = 120
+# Повторы при временных ошибках: до DELIVERY_MAX_ATTEMPTS попыток,
+# пауза DELIVERY_RETRY_BASE * 2^(попытка - 1) секунд, но не больше DELIVERY_RETRY_MAX
+DELIVERY_MAX_ATTEMPTS = 5
+DELIVERY_RETRY_BASE = 5
+DELIVERY_RETRY_MAX = 300
+# Отложенная доставка: валентинки, отправленные до DELIVERY_RELEASE_AT
+# (местное время сервера, "ГГГГ-ММ-ДД ЧЧ:ММ:СС"), копятся и доставляются разом
+# в этот момент. Картинки к ним рисуются заранее, пока бот простаивает, и
+# хранятся в PRERENDER_PATH. По умолчанию выключено (пустая строка) - чтобы
+# включить, укажите время, например DELIVERY_RELEASE_AT = SPOILER_VALENTINE
+DELIVERY_RELEASE_AT = ""
+PRERENDER_PATH = "prerendered"
+PRERENDER_BATCH_SIZE = 10
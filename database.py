@@ -1,165 +1,1549 @@
+import asyncio
+import functools
+import os
 import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from config import DB_PATH
+from config import (
+    DB_PATH, DB_READ_WORKERS, DB_QUEUE_SIZE, DB_TIMEOUT,
+    DB_WRITE_BEHIND, DB_WRITE_BEHIND_MS, DB_WRITE_BEHIND_ROWS, DB_WRITE_BEHIND_SYNCHRONOUS,
+    QUEUE_CLAIM_TIMEOUT, COUNTER_BUCKETS_KEEP_MINUTES, USERS_PAGE_SIZE,
+    USER_CACHE_SIZE, USER_CACHE_TTL,
+    ARCHIVE_DB_PATH, ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE, VACUUM_STEP_PAGES, VACUUM_MAX_STEPS,
+    DELIVERY_MAX_FAILURES, OUTBOX_CLAIM_TIMEOUT
+)
 from typing import Optional, List, Dict
 
-class Database:
-    def __init__(self):
-        self.db_path = DB_PATH
-        self.init_db()
 
-    def init_db(self):
-        """Инициализация базы данных"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        # Таблица пользователей
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT UNIQUE,
-                first_name TEXT,
-                last_name TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+class ConnectionManager:
+    """
+    Долгоживущие соединения с SQLite
 
-        # Таблица вал��нтинок
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS valentines (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender_id INTEGER,
-                recipient_id INTEGER,
-                recipient_username TEXT,
-                text TEXT,
-                image_template INTEGER,
-                is_anonymous BOOLEAN DEFAULT 1,
-                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                delivered BOOLEAN DEFAULT 0
+    У каждого потока своё соединение: оно открывается один раз, настраивается
+    прагмами (WAL, synchronous, размеры кэша) и дальше переиспользуется.
+    Подготовленные запросы кэшируются самим sqlite3 внутри соединения.
+    """
+
+    PRAGMAS = (
+        ("auto_vacuum", "INCREMENTAL"),    # до WAL: действует только для новой базы
+        ("journal_mode", "WAL"),           # читатели не блокируют писателя
+        ("synchronous", "NORMAL"),         # в WAL fsync только на чекпоинтах
+        ("cache_size", -16000),            # ~16 МБ кэша страниц
+        ("mmap_size", 256 * 1024 * 1024),  # чтение через mmap
+        ("temp_store", "MEMORY"),
+        ("busy_timeout", 5000),            # ждать блокировку вместо ошибки
+    )
+
+    # Класс соединения (check_queries подставляет свой, чтобы записывать запросы с параметрами)
+    factory = sqlite3.Connection
+
+    def __init__(self, db_path: str, cached_statements: int = 256):
+        self.db_path = db_path
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        """Открыть и настроить новое соединение"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=30,
+            cached_statements=self.cached_statements,
+            check_same_thread=False,  # используется только своим потоком, закрывается из close_all
+            factory=self.factory,
+        )
+        for name, value in self.PRAGMAS:
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def get(self) -> sqlite3.Connection:
+        """Соединение текущего потока"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close_all(self):
+        """Закрыть все соединения (при остановке бота)"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                print(f"Error closing connection: {e}")
+        self._local = threading.local()
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> set:
+    """Колонки таблицы"""
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_column(conn: sqlite3.Connection, table: str, column: str, definition: str):
+    """Добавить колонку, если её еще нет (в старых базах схема могла отличаться)"""
+    if column not in _columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+# Миграции схемы по порядку: номер версии = позиция в списке + 1.
+# Применённые миграции не меняются - любое изменение схемы это новая миграция в конце.
+# Шаг миграции - SQL-строка или функция, которая получает соединение.
+MIGRATIONS = [
+    ("Начальная схема", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT UNIQUE,
+            first_name TEXT,
+            last_name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS valentines (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id INTEGER,
+            recipient_id INTEGER,
+            recipient_username TEXT,
+            text TEXT,
+            image_template INTEGER,
+            is_anonymous BOOLEAN DEFAULT 1,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            delivered BOOLEAN DEFAULT 0
+        )
+        """,
+        # Очередь для невидимых пользователей
+        """
+        CREATE TABLE IF NOT EXISTS queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id INTEGER,
+            recipient_username TEXT,
+            text TEXT,
+            image_template INTEGER,
+            is_anonymous BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    ("Выдача из очереди (claim_queued)", [
+        lambda conn: _add_column(conn, "queue", "claimed_at", "TIMESTAMP"),
+    ]),
+    ("Индексы для очереди и статистики", [
+        "CREATE INDEX IF NOT EXISTS idx_queue_recipient ON queue (recipient_username)",
+        "CREATE INDEX IF NOT EXISTS idx_valentines_recipient ON valentines (recipient_id)",
+        "CREATE INDEX IF NOT EXISTS idx_valentines_sender ON valentines (sender_id)",
+        "CREATE INDEX IF NOT EXISTS idx_valentines_delivered ON valentines (delivered)",
+    ]),
+    ("Счетчики статистики", [
+        # Итоговые значения (total_users, delivered, in_queue)
+        """
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        """,
+        # Поминутные значения: sent, new_users - приращения, queue_depth - последняя глубина очереди
+        """
+        CREATE TABLE IF NOT EXISTS counter_buckets (
+            minute TEXT,
+            name TEXT,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (minute, name)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_insert AFTER INSERT ON users BEGIN
+            UPDATE counters SET value = value + 1 WHERE name = 'total_users';
+            INSERT INTO counter_buckets (minute, name, value)
+            VALUES (strftime('%Y-%m-%d %H:%M', 'now'), 'new_users', 1)
+            ON CONFLICT (minute, name) DO UPDATE SET value = value + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_delete AFTER DELETE ON users BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = 'total_users';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_valentines_insert AFTER INSERT ON valentines BEGIN
+            UPDATE counters SET value = value + 1 WHERE name = 'delivered' AND NEW.delivered = 1;
+            INSERT INTO counter_buckets (minute, name, value)
+            VALUES (strftime('%Y-%m-%d %H:%M', 'now'), 'sent', 1)
+            ON CONFLICT (minute, name) DO UPDATE SET value = value + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_valentines_delivered AFTER UPDATE OF delivered ON valentines
+        WHEN NEW.delivered IS NOT OLD.delivered BEGIN
+            UPDATE counters SET value = value + (NEW.delivered = 1) - (OLD.delivered = 1)
+            WHERE name = 'delivered';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_valentines_delete AFTER DELETE ON valentines
+        WHEN OLD.delivered = 1 BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = 'delivered';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_queue_insert AFTER INSERT ON queue BEGIN
+            UPDATE counters SET value = value + 1 WHERE name = 'in_queue';
+            INSERT INTO counter_buckets (minute, name, value)
+            VALUES (strftime('%Y-%m-%d %H:%M', 'now'), 'queue_depth',
+                    (SELECT value FROM counters WHERE name = 'in_queue'))
+            ON CONFLICT (minute, name) DO UPDATE SET value = excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_queue_delete AFTER DELETE ON queue BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = 'in_queue';
+            INSERT INTO counter_buckets (minute, name, value)
+            VALUES (strftime('%Y-%m-%d %H:%M', 'now'), 'queue_depth',
+                    (SELECT value FROM counters WHERE name = 'in_queue'))
+            ON CONFLICT (minute, name) DO UPDATE SET value = excluded.value;
+        END
+        """,
+        # Начальные значения по уже накопленным данным
+        lambda conn: rebuild_counters(conn),
+    ]),
+    ("Активность и блокировка пользователей", [
+        lambda conn: _add_column(conn, "users", "last_seen_at", "TIMESTAMP"),
+        lambda conn: _add_column(conn, "users", "blocked", "BOOLEAN NOT NULL DEFAULT 0"),
+        "UPDATE users SET last_seen_at = created_at WHERE last_seen_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen_at)",
+    ]),
+    ("Username без учета регистра", [
+        lambda conn: _add_column(conn, "users", "username_norm", "TEXT"),
+        "UPDATE users SET username_norm = lower(username) WHERE username IS NOT NULL",
+        # Если username отличались только регистром, он остается за последним активным
+        """
+        UPDATE users SET username_norm = NULL WHERE user_id IN (
+            SELECT user_id FROM (
+                SELECT user_id, ROW_NUMBER() OVER (
+                    PARTITION BY username_norm ORDER BY last_seen_at DESC, user_id DESC
+                ) AS position
+                FROM users WHERE username_norm IS NOT NULL
             )
-        """)
+            WHERE position > 1
+        )
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username_norm ON users (username_norm)",
+        # Очередь тоже хранит нормализованный username получателя
+        "UPDATE queue SET recipient_username = lower(ltrim(trim(recipient_username), '@'))",
+    ]),
+    ("Фоновые рассылки", [
+        # cursor - все пользователи с user_id <= cursor уже обработаны
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            cursor INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            admin_chat_id INTEGER,
+            status_message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status)",
+        # Кому уже отправлено после cursor (отправки идут параллельно и завершаются не по порядку)
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INTEGER,
+            user_id INTEGER,
+            ok BOOLEAN,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+        """,
+    ]),
+    ("Ошибки доставки пользователям", [
+        lambda conn: _add_column(conn, "users", "last_error", "TEXT"),
+        lambda conn: _add_column(conn, "users", "last_error_at", "TIMESTAMP"),
+        lambda conn: _add_column(conn, "users", "consecutive_failures", "INTEGER NOT NULL DEFAULT 0"),
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_blocked AFTER UPDATE OF blocked ON users
+        WHEN NEW.blocked IS NOT OLD.blocked BEGIN
+            UPDATE counters SET value = value + (NEW.blocked = 1) - (OLD.blocked = 1)
+            WHERE name = 'blocked_users';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_delete_blocked AFTER DELETE ON users
+        WHEN OLD.blocked = 1 BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = 'blocked_users';
+        END
+        """,
+        # Покрывающий индекс (blocked, user_id) для списка доступных пользователей
+        "CREATE INDEX IF NOT EXISTS idx_users_blocked ON users (blocked)",
+        "INSERT OR REPLACE INTO counters (name, value) SELECT 'blocked_users', COUNT(*) FROM users WHERE blocked = 1",
+    ]),
+    ("Outbox доставки валентинок", [
+        # status: NULL - записи до outbox, pending -> sending -> delivered / failed
+        lambda conn: _add_column(conn, "valentines", "status", "TEXT"),
+        lambda conn: _add_column(conn, "valentines", "attempts", "INTEGER NOT NULL DEFAULT 0"),
+        lambda conn: _add_column(conn, "valentines", "next_attempt_at", "TIMESTAMP"),
+        lambda conn: _add_column(conn, "valentines", "claimed_at", "TIMESTAMP"),
+        lambda conn: _add_column(conn, "valentines", "delivered_at", "TIMESTAMP"),
+        lambda conn: _add_column(conn, "valentines", "last_error", "TEXT"),
+        "CREATE INDEX IF NOT EXISTS idx_valentines_outbox ON valentines (status, next_attempt_at)",
+        # Поминутно: сколько доставлено и суммарная задержка доставки (мс)
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_valentines_delivered_bucket AFTER UPDATE OF delivered ON valentines
+        WHEN NEW.delivered = 1 AND OLD.delivered IS NOT 1 BEGIN
+            INSERT INTO counter_buckets (minute, name, value)
+            VALUES (strftime('%Y-%m-%d %H:%M', 'now'), 'delivered', 1)
+            ON CONFLICT (minute, name) DO UPDATE SET value = value + 1;
+            INSERT INTO counter_buckets (minute, name, value)
+            VALUES (strftime('%Y-%m-%d %H:%M', 'now'), 'delivery_latency_ms',
+                    CAST((julianday(COALESCE(NEW.delivered_at, 'now')) - julianday(NEW.sent_at)) * 86400000 AS INTEGER))
+            ON CONFLICT (minute, name) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+    ]),
+    ("Отложенная доставка и заранее отрисованные картинки", [
+        # release_at - время выпуска (NULL - сразу), rendered_path - готовая картинка
+        lambda conn: _add_column(conn, "valentines", "release_at", "TIMESTAMP"),
+        lambda conn: _add_column(conn, "valentines", "rendered_path", "TEXT"),
+        # Задержку доставки отложенных валентинок считаем от времени выпуска
+        "DROP TRIGGER IF EXISTS trg_valentines_delivered_bucket",
+        """
+        CREATE TRIGGER trg_valentines_delivered_bucket AFTER UPDATE OF delivered ON valentines
+        WHEN NEW.delivered = 1 AND OLD.delivered IS NOT 1 BEGIN
+            INSERT INTO counter_buckets (minute, name, value)
+            VALUES (strftime('%Y-%m-%d %H:%M', 'now'), 'delivered', 1)
+            ON CONFLICT (minute, name) DO UPDATE SET value = value + 1;
+            INSERT INTO counter_buckets (minute, name, value)
+            VALUES (strftime('%Y-%m-%d %H:%M', 'now'), 'delivery_latency_ms',
+                    CAST((julianday(COALESCE(NEW.delivered_at, 'now'))
+                          - julianday(MAX(NEW.sent_at, COALESCE(NEW.release_at, NEW.sent_at)))) * 86400000 AS INTEGER))
+            ON CONFLICT (minute, name) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+    ]),
+    ("Кэш file_id картинок", [
+        # key - хэш содержимого картинки (ImageProcessor.media_key)
+        """
+        CREATE TABLE IF NOT EXISTS media_cache (
+            key TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+        """,
+    ]),
+    ("Владелец выдачи из outbox", [
+        # claim_token - кто из воркеров сейчас отправляет валентинку
+        lambda conn: _add_column(conn, "valentines", "claim_token", "TEXT"),
+    ]),
+]
 
-        # Таблица очереди (для невидимых пользователей)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS queue (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender_id INTEGER,
-                recipient_username TEXT,
-                text TEXT,
-                image_template INTEGER,
-                is_anonymous BOOLEAN DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+
+def rebuild_counters(conn: sqlite3.Connection, keep_minutes: int = COUNTER_BUCKETS_KEEP_MINUTES):
+    """
+    Пересчитать счетчики статистики по таблицам с нуля
+
+    Поминутные sent, new_users и delivered восстанавливаются по
+    sent_at/created_at/delivered_at за последние keep_minutes минут, глубина
+    очереди - только для текущей минуты.
+    Вызывается внутри транзакции, в том числе из миграции 4, поэтому колонки
+    из более поздних миграций учитываются, только если они уже есть.
+    """
+    since = f"-{int(keep_minutes)} minutes"
+    user_columns = _columns(conn, "users")
+    valentine_columns = _columns(conn, "valentines")
+    totals = {
+        "total_users": conn.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+        "delivered": conn.execute("SELECT COUNT(*) FROM valentines WHERE delivered = 1").fetchone()[0],
+        "in_queue": conn.execute("SELECT COUNT(*) FROM queue").fetchone()[0],
+    }
+    if "blocked" in user_columns:
+        totals["blocked_users"] = conn.execute("SELECT COUNT(*) FROM users WHERE blocked = 1").fetchone()[0]
+    conn.executemany("""
+        INSERT INTO counters (name, value) VALUES (?, ?)
+        ON CONFLICT (name) DO UPDATE SET value = excluded.value
+    """, totals.items())
+
+    conn.execute("DELETE FROM counter_buckets")
+    conn.execute("""
+        INSERT INTO counter_buckets (minute, name, value)
+        SELECT strftime('%Y-%m-%d %H:%M', sent_at), 'sent', COUNT(*) FROM valentines
+        WHERE sent_at >= datetime('now', ?)
+        GROUP BY 1
+    """, (since,))
+    conn.execute("""
+        INSERT INTO counter_buckets (minute, name, value)
+        SELECT strftime('%Y-%m-%d %H:%M', created_at), 'new_users', COUNT(*) FROM users
+        WHERE created_at >= datetime('now', ?)
+        GROUP BY 1
+    """, (since,))
+    if "delivered_at" in valentine_columns:
+        # Задержка отложенных валентинок считается от времени выпуска
+        started = "MAX(sent_at, COALESCE(release_at, sent_at))" if "release_at" in valentine_columns else "sent_at"
+        conn.execute(f"""
+            INSERT INTO counter_buckets (minute, name, value)
+            SELECT strftime('%Y-%m-%d %H:%M', delivered_at), name, value FROM (
+                SELECT delivered_at, 'delivered' AS name, COUNT(*) AS value FROM valentines
+                WHERE delivered_at >= datetime('now', ?)
+                GROUP BY strftime('%Y-%m-%d %H:%M', delivered_at)
+                UNION ALL
+                SELECT delivered_at, 'delivery_latency_ms',
+                       SUM(CAST((julianday(delivered_at) - julianday({started})) * 86400000 AS INTEGER))
+                FROM valentines
+                WHERE delivered_at >= datetime('now', ?)
+                GROUP BY strftime('%Y-%m-%d %H:%M', delivered_at)
             )
-        """)
+        """, (since, since))
+    conn.execute("""
+        INSERT INTO counter_buckets (minute, name, value)
+        VALUES (strftime('%Y-%m-%d %H:%M', 'now'), 'queue_depth', ?)
+    """, (totals["in_queue"],))
 
-        conn.commit()
-        conn.close()
 
-    def add_user(self, user_id: int, username: str, first_name: str, last_name: str = ""):
-        """Добавить пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+def migrate(conn: sqlite3.Connection, migrations: list = MIGRATIONS) -> int:
+    """
+    Применить недостающие миграции по PRAGMA user_version
+
+    Каждая миграция выполняется в своей транзакции вместе с повышением версии,
+    поэтому прерванный запуск не оставляет схему наполовину измененной.
+    Возвращает итоговую версию схемы.
+    """
+    while True:
+        # BEGIN IMMEDIATE: если бот запущен дважды, миграции применит только один
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            cursor.execute("""
-                INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
-                VALUES (?, ?, ?, ?)
-            """, (user_id, username, first_name, last_name))
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(migrations):
+                conn.rollback()
+                return version
+
+            description, steps = migrations[version]
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
             conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"🗄 Миграция базы #{version + 1}: {description}")
+
+
+# Username, который пользователь сменил, освобождается для нового владельца
+_RELEASE_USERNAME_SQL = """
+    UPDATE users SET username = NULL, username_norm = NULL
+    WHERE username_norm = :username_norm AND user_id != :user_id
+"""
+
+# Повторный /start обновляет username и время последней активности
+# и снова делает доступным пользователя, которому не удавалось доставить сообщения
+_UPSERT_USER_SQL = """
+    INSERT OR IGNORE INTO users (user_id, username, username_norm, first_name, last_name,
+                                 created_at, last_seen_at)
+    VALUES (:user_id, :username, :username_norm, :first_name, :last_name, :seen_at, :seen_at)
+    ON CONFLICT (user_id) DO UPDATE SET
+        username = excluded.username,
+        username_norm = excluded.username_norm,
+        last_seen_at = excluded.last_seen_at,
+        blocked = 0,
+        consecutive_failures = 0
+"""
+
+
+def _broadcast_from_row(row: tuple) -> Dict:
+    keys = ("id", "text", "status", "cursor", "sent", "failed", "total", "admin_chat_id",
+            "status_message_id", "created_at", "updated_at")
+    return dict(zip(keys, row))
+
+
+def normalize_username(username: Optional[str]) -> Optional[str]:
+    """@Name, name, NAME -> name (username в Telegram не зависят от регистра)"""
+    if not username:
+        return None
+    return username.strip().lstrip("@").lower() or None
+
+
+def _utc_timestamp() -> str:
+    """Текущее время в формате CURRENT_TIMESTAMP SQLite"""
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _format_timestamp(value: Optional[datetime]) -> Optional[str]:
+    """datetime (UTC) -> строка в формате CURRENT_TIMESTAMP SQLite"""
+    return value.strftime("%Y-%m-%d %H:%M:%S") if value else None
+
+
+class WriteBehindBuffer:
+    """
+    Буфер отложенной записи (group commit) для add_user и save_valentine
+
+    Строки копятся в памяти и записываются одной транзакцией раз в interval_ms
+    или как только их наберется max_rows. При падении процесса теряется не больше
+    одного интервала; synchronous задает, насколько надежен сам сброс (NORMAL/FULL).
+    """
+
+    def __init__(self, connections: ConnectionManager, interval_ms: int = DB_WRITE_BEHIND_MS,
+                 max_rows: int = DB_WRITE_BEHIND_ROWS, synchronous: str = DB_WRITE_BEHIND_SYNCHRONOUS,
+                 on_flush=None):
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        # Вызывается со списком записанных пользователей сразу после коммита
+        self.on_flush = on_flush
+
+        # Отдельное соединение только для сброса буфера (используется под _flush_lock)
+        self._conn = connections._open()
+        self._conn.execute(f"PRAGMA synchronous = {synchronous}")
+
+        self._users = {}       # user_id -> строка для _UPSERT_USER_SQL
+        self._valentines = []  # (sender_id, recipient_id, ..., is_anonymous, sent_at)
+        self._flushing_users = {}  # строки, которые сейчас записываются (видны для чтения)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="db-write-behind", daemon=True)
+        self._thread.start()
+
+    def add_user(self, row: dict):
+        with self._lock:
+            self._users[row["user_id"]] = row
+            self._notify_if_full()
+
+    def add_valentine(self, row: tuple):
+        with self._lock:
+            self._valentines.append(row)
+            self._notify_if_full()
+
+    def _notify_if_full(self):
+        if len(self._users) + len(self._valentines) >= self.max_rows:
+            self._wakeup.set()
+
+    def find_user(self, username_norm: str) -> Optional[dict]:
+        """Найти еще не записанного пользователя по нормализованному username"""
+        with self._lock:
+            for users in (self._users, self._flushing_users):
+                for row in users.values():
+                    if row["username_norm"] == username_norm:
+                        return row
+        return None
+
+    def is_pending(self, user_id: int) -> bool:
+        """Есть ли по пользователю еще не записанные изменения"""
+        with self._lock:
+            return user_id in self._users or user_id in self._flushing_users
+
+    def flush(self):
+        """Записать всё накопленное одной транзакцией"""
+        with self._flush_lock:
+            with self._lock:
+                users, self._users = self._users, {}
+                valentines, self._valentines = self._valentines, []
+                self._flushing_users = users
+            if not users and not valentines:
+                return
+
+            try:
+                with self._conn:
+                    for row in users.values():
+                        self._conn.execute(_RELEASE_USERNAME_SQL, row)
+                        self._conn.execute(_UPSERT_USER_SQL, row)
+                    self._conn.executemany("""
+                        INSERT INTO valentines (sender_id, recipient_id, recipient_username, text,
+                                               image_template, is_anonymous, sent_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """, valentines)
+                if self.on_flush and users:
+                    self.on_flush(list(users.values()))
+            except Exception as e:
+                # Возвращаем строки в буфер, чтобы записать их при следующем сбросе
+                print(f"Error flushing write buffer: {e}")
+                with self._lock:
+                    for user_id, row in users.items():
+                        self._users.setdefault(user_id, row)
+                    self._valentines[:0] = valentines
+            finally:
+                with self._lock:
+                    self._flushing_users = {}
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """Остановить фоновый сброс и записать остаток"""
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        self._conn.close()
+
+
+class UserCache:
+    """
+    LRU-кэш username -> пользователь с ограниченным временем жизни записей
+
+    Кэшируются и промахи (пользователя нет в базе), поэтому add_user обязан
+    вызывать invalidate. version защищает от гонки: если запись инвалидирована,
+    пока читатель ходил в базу, его устаревший результат не попадет в кэш.
+    """
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # username_norm -> (expires_at, user или None)
+        self._by_user = {}             # user_id -> username_norm
+        self._lock = threading.Lock()
+
+    def get(self, username_norm: str):
+        """(True, пользователь или None) если запись в кэше, иначе (False, None)"""
+        with self._lock:
+            entry = self._entries.get(username_norm)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(username_norm)
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+            return False, None
+
+    def put(self, username_norm: str, user: Optional[Dict], version: int):
+        with self._lock:
+            if version != self.version or self.max_size <= 0:
+                return
+            self._entries[username_norm] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(username_norm)
+            if user:
+                self._by_user[user["user_id"]] = username_norm
+            while len(self._entries) > self.max_size:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                if evicted:
+                    self._by_user.pop(evicted["user_id"], None)
+
+    def invalidate(self, username_norm: Optional[str], user_id: Optional[int] = None):
+        """Сбросить запись по username и прежний username пользователя user_id"""
+        with self._lock:
+            self.version += 1
+            for key in (username_norm, self._by_user.pop(user_id, None)):
+                if key is not None:
+                    self._entries.pop(key, None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+class Database:
+    def __init__(self, db_path: str = DB_PATH, write_behind: bool = DB_WRITE_BEHIND,
+                 archive_path: str = ARCHIVE_DB_PATH):
+        self.db_path = db_path
+        self.archive_path = archive_path
+        self.connections = ConnectionManager(self.db_path)
+        self.init_db()
+        # Отложенная запись add_user/save_valentine (см. WriteBehindBuffer)
+        self.user_cache = UserCache()
+        self.write_buffer = WriteBehindBuffer(
+            self.connections, on_flush=self._invalidate_users
+        ) if write_behind else None
+
+    def close(self):
+        """Записать отложенные строки и закрыть соединения с базой"""
+        if self.write_buffer:
+            self.write_buffer.close()
+        self.connections.close_all()
+
+    def _invalidate_users(self, rows: List[dict]):
+        """Сбросить кэш по пользователям, записанным из буфера"""
+        for row in rows:
+            self.user_cache.invalidate(row["username_norm"], row["user_id"])
+
+    def flush(self):
+        """Записать отложенные строки (если включена отложенная запись)"""
+        if self.write_buffer:
+            self.write_buffer.flush()
+
+    def init_db(self):
+        """Инициализация базы данных: применить недостающие миграции"""
+        conn = self.connections.get()
+        migrate(conn)
+        self.prune_counter_buckets()
+
+        # Счетчик archived появился позже архива: один раз считаем архив целиком
+        if conn.execute("SELECT 1 FROM counters WHERE name = 'archived'").fetchone() is None:
+            archived = self._count_archived(conn)
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('archived', ?)", (archived,))
+
+    def add_user(self, user_id: int, username: str, first_name: str, last_name: str = ""):
+        """Добавить пользователя (или обновить username и время активности)"""
+        row = {
+            "user_id": user_id,
+            "username": username,
+            "username_norm": normalize_username(username),
+            "first_name": first_name,
+            "last_name": last_name,
+            "seen_at": _utc_timestamp(),
+        }
+        self.user_cache.invalidate(row["username_norm"], user_id)
+
+        if self.write_buffer:
+            self.write_buffer.add_user(row)
+            return
+
+        conn = self.connections.get()
+        try:
+            with conn:
+                conn.execute(_RELEASE_USERNAME_SQL, row)
+                conn.execute(_UPSERT_USER_SQL, row)
         except Exception as e:
             print(f"Error adding user: {e}")
-        finally:
-            conn.close()
 
     def get_user_by_username(self, username: str) -> Optional[Dict]:
-        """Получить пользователя по username"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id, username, first_name FROM users WHERE username = ?", (username,))
-        row = cursor.fetchone()
-        conn.close()
-        
-        if row:
-            return {"user_id": row[0], "username": row[1], "first_name": row[2]}
-        return None
+        """Получить пользователя по username (без учета регистра и @)"""
+        return self.resolve_usernames([username])[username]
+
+    def resolve_usernames(self, usernames: List[str]) -> Dict[str, Optional[Dict]]:
+        """
+        Найти пользователей по списку username одним запросом
+
+        Returns:
+            {username из запроса: пользователь или None}
+        """
+        users = {}
+        missing = {}
+        for username in usernames:
+            username_norm = normalize_username(username)
+            if username_norm is None:
+                users[username] = None
+                continue
+
+            # Пользователь мог только что добавиться и еще не попасть в базу
+            row = self.write_buffer.find_user(username_norm) if self.write_buffer else None
+            if row:
+                users[username] = {"user_id": row["user_id"], "username": row["username"],
+                                   "first_name": row["first_name"]}
+                continue
+
+            found, user = self.user_cache.get(username_norm)
+            if found:
+                users[username] = dict(user) if user else None
+            else:
+                missing.setdefault(username_norm, []).append(username)
+
+        if missing:
+            version = self.user_cache.version
+            conn = self.connections.get()
+            names = list(missing)
+            rows = {}
+            for i in range(0, len(names), 500):
+                chunk = names[i:i + 500]
+                rows.update((row[3], row[:3]) for row in conn.execute(f"""
+                    SELECT user_id, username, first_name, username_norm FROM users
+                    WHERE username_norm IN ({", ".join("?" * len(chunk))})
+                """, chunk))
+
+            for username_norm, requested in missing.items():
+                row = rows.get(username_norm)
+                user = {"user_id": row[0], "username": row[1], "first_name": row[2]} if row else None
+                if user and self.write_buffer and self.write_buffer.is_pending(user["user_id"]):
+                    # В буфере у пользователя уже другой username, в базе - устаревший
+                    user = None
+                else:
+                    self.user_cache.put(username_norm, user, version)
+                for username in requested:
+                    users[username] = dict(user) if user else None
+
+        return users
+
+    def get_user_cache_stats(self) -> Dict:
+        """Счетчики попаданий кэша username -> пользователь"""
+        return self.user_cache.stats()
 
     def save_valentine(self, sender_id: int, recipient_id: Optional[int], recipient_username: str,
                       text: str, image_template: int, is_anonymous: bool):
         """Сохранить валентинку"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO valentines (sender_id, recipient_id, recipient_username, text, 
-                                   image_template, is_anonymous)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (sender_id, recipient_id, recipient_username, text, image_template, is_anonymous))
-        
-        conn.commit()
-        conn.close()
+        if self.write_buffer:
+            self.write_buffer.add_valentine((sender_id, recipient_id, recipient_username, text,
+                                             image_template, is_anonymous, _utc_timestamp()))
+            return
+
+        conn = self.connections.get()
+        with conn:
+            conn.execute("""
+                INSERT INTO valentines (sender_id, recipient_id, recipient_username, text, 
+                                       image_template, is_anonymous)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (sender_id, recipient_id, recipient_username, text, image_template, is_anonymous))
+
+    def enqueue_valentine(self, sender_id: int, recipient_id: int, recipient_username: str,
+                          text: str, image_template: Optional[int], is_anonymous: bool,
+                          release_at: Optional[datetime] = None) -> int:
+        """
+        Сохранить валентинку для доставки в фоне (outbox)
+
+        Запись сразу фиксируется в статусе pending, отправкой занимаются
+        воркеры DeliveryService. release_at (UTC) - не доставлять раньше этого
+        времени, None - доставить сразу. Возвращает id валентинки.
+        """
+        release_at = _format_timestamp(release_at)
+        conn = self.connections.get()
+        with conn:
+            cursor = conn.execute("""
+                INSERT INTO valentines (sender_id, recipient_id, recipient_username, text,
+                                       image_template, is_anonymous, status, release_at, next_attempt_at)
+                VALUES (?, ?, ?, ?, ?, ?, 'pending', ?, COALESCE(?, CURRENT_TIMESTAMP))
+            """, (sender_id, recipient_id, recipient_username, text, image_template, is_anonymous,
+                  release_at, release_at))
+        return cursor.lastrowid
+
+    def get_prerender_batch(self, limit: int = 20) -> List[Dict]:
+        """
+        Отложенные валентинки с картинкой, которые еще не отрисованы
+
+        Только ждущие выпуска (release_at в будущем, попыток еще не было) -
+        не повторы. Ближайшие к выпуску первыми, чтобы к пику были готовы в
+        первую очередь они.
+        """
+        conn = self.connections.get()
+        rows = conn.execute("""
+            SELECT v.id, v.sender_id, v.text, v.image_template, v.is_anonymous,
+                   u.first_name, u.username
+            FROM valentines v LEFT JOIN users u ON u.user_id = v.sender_id
+            WHERE v.status = 'pending' AND v.image_template IS NOT NULL AND v.rendered_path IS NULL
+              AND v.next_attempt_at > CURRENT_TIMESTAMP
+              AND v.attempts = 0 AND v.release_at > CURRENT_TIMESTAMP
+            ORDER BY v.next_attempt_at
+            LIMIT ?
+        """, (limit,)).fetchall()
+        keys = ("id", "sender_id", "text", "image_template", "is_anonymous",
+                "sender_first_name", "sender_username")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def set_rendered_path(self, valentine_id: int, path: str) -> bool:
+        """
+        Запомнить заранее отрисованную картинку
+
+        Возвращает False, если валентинку уже забрали на отправку - тогда
+        файл не нужен.
+        """
+        conn = self.connections.get()
+        with conn:
+            cursor = conn.execute("""
+                UPDATE valentines SET rendered_path = ? WHERE id = ? AND status = 'pending'
+            """, (path, valentine_id))
+        return cursor.rowcount > 0
+
+    def claim_outbox(self, limit: int = 20, claim_timeout: int = OUTBOX_CLAIM_TIMEOUT) -> List[Dict]:
+        """
+        Забрать пачку валентинок на доставку
+
+        Сначала берутся sending, которые никто не подтвердил (touch_claim) за
+        claim_timeout секунд (воркер упал), - иначе при большой очереди они
+        ждали бы, пока она не кончится. Затем pending, у которых подошло время
+        попытки (по порядку этого времени, т.е. отложенные - в порядке
+        выпуска). Одним UPDATE, поэтому два воркера не получат одну и ту же валентинку.
+
+        Каждая выдача помечается своим claim_token: отметить результат
+        (mark_delivered, mark_failed) может только тот, кому валентинка выдана
+        последней.
+        """
+        token = uuid.uuid4().hex
+        conn = self.connections.get()
+        with conn:
+            ids = [row[0] for row in conn.execute("""
+                UPDATE valentines
+                SET status = 'sending', claimed_at = CURRENT_TIMESTAMP, claim_token = ?,
+                    attempts = attempts + 1
+                WHERE id IN (
+                    SELECT id FROM (
+                        SELECT * FROM (
+                            SELECT id, 0 AS queue, claimed_at AS due FROM valentines
+                            WHERE status = 'sending' AND claimed_at <= datetime('now', ?)
+                            ORDER BY claimed_at LIMIT ?
+                        )
+                        UNION ALL
+                        SELECT * FROM (
+                            SELECT id, 1 AS queue, next_attempt_at AS due FROM valentines
+                            WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+                            ORDER BY next_attempt_at LIMIT ?
+                        )
+                    )
+                    ORDER BY queue, due
+                    LIMIT ?
+                )
+                RETURNING id
+            """, (token, f"-{int(claim_timeout)} seconds", limit, limit, limit))]
+            if not ids:
+                return []
+
+            rows = conn.execute(f"""
+                SELECT v.id, v.sender_id, v.recipient_id, v.text, v.image_template, v.is_anonymous,
+                       v.attempts, v.sent_at, v.rendered_path, v.claim_token, u.first_name, u.username
+                FROM valentines v LEFT JOIN users u ON u.user_id = v.sender_id
+                WHERE v.id IN ({", ".join("?" * len(ids))})
+                ORDER BY v.next_attempt_at, v.id
+            """, ids).fetchall()
+
+        keys = ("id", "sender_id", "recipient_id", "text", "image_template", "is_anonymous",
+                "attempts", "sent_at", "rendered_path", "claim_token", "sender_first_name", "sender_username")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def touch_claim(self, valentine_id: int, claim_token: str) -> bool:
+        """
+        Подтвердить выдачу прямо перед отправкой (продлевает claim_timeout)
+
+        Возвращает False, если валентинку уже выдали другому воркеру - тогда
+        отправлять её нельзя.
+        """
+        conn = self.connections.get()
+        with conn:
+            cursor = conn.execute("""
+                UPDATE valentines SET claimed_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'sending' AND claim_token = ?
+            """, (valentine_id, claim_token))
+        return cursor.rowcount > 0
+
+    def mark_delivered(self, valentine_id: int, claim_token: str) -> bool:
+        """Отметить валентинку доставленной (False - выдача уже не наша)"""
+        conn = self.connections.get()
+        with conn:
+            cursor = conn.execute("""
+                UPDATE valentines
+                SET status = 'delivered', delivered = 1, delivered_at = CURRENT_TIMESTAMP,
+                    last_error = NULL, claim_token = NULL
+                WHERE id = ? AND status = 'sending' AND claim_token = ?
+            """, (valentine_id, claim_token))
+        return cursor.rowcount > 0
+
+    def mark_failed(self, valentine_id: int, claim_token: str, error: str,
+                    retry_in: Optional[float] = None) -> bool:
+        """
+        Отметить неудачную попытку доставки (False - выдача уже не наша)
+
+        retry_in - через сколько секунд повторить; None - больше не пытаться (failed)
+        """
+        conn = self.connections.get()
+        with conn:
+            if retry_in is None:
+                cursor = conn.execute("""
+                    UPDATE valentines SET status = 'failed', last_error = ?, claim_token = NULL
+                    WHERE id = ? AND status = 'sending' AND claim_token = ?
+                """, (error, valentine_id, claim_token))
+            else:
+                cursor = conn.execute("""
+                    UPDATE valentines
+                    SET status = 'pending', last_error = ?, next_attempt_at = datetime('now', ?),
+                        claim_token = NULL
+                    WHERE id = ? AND status = 'sending' AND claim_token = ?
+                """, (error, f"+{int(retry_in)} seconds", valentine_id, claim_token))
+        return cursor.rowcount > 0
+
+    def get_outbox_stats(self) -> Dict:
+        """
+        Сколько валентинок ждут доставки, отправляются и не доставлены
+
+        scheduled - из ждущих те, чье время еще не пришло (отложенные и
+        повторы), prerendered - из них уже с готовой картинкой.
+        """
+        conn = self.connections.get()
+        counts = dict(conn.execute("""
+            SELECT status, COUNT(*) FROM valentines
+            WHERE status IN ('pending', 'sending', 'failed')
+            GROUP BY status
+        """))
+        stats = {status: counts.get(status, 0) for status in ("pending", "sending", "failed")}
+        stats["scheduled"], stats["prerendered"] = conn.execute("""
+            SELECT COUNT(*), COUNT(rendered_path) FROM valentines
+            WHERE status = 'pending' AND next_attempt_at > CURRENT_TIMESTAMP
+        """).fetchone()
+        return stats
+
+    def get_file_id(self, key: str) -> Optional[str]:
+        """file_id Telegram для картинки с этим хэшем содержимого или None"""
+        conn = self.connections.get()
+        row = conn.execute("SELECT file_id FROM media_cache WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def save_file_id(self, key: str, file_id: str):
+        """Запомнить file_id загруженной в Telegram картинки"""
+        conn = self.connections.get()
+        with conn:
+            conn.execute("""
+                INSERT INTO media_cache (key, file_id) VALUES (?, ?)
+                ON CONFLICT (key) DO UPDATE SET file_id = excluded.file_id, created_at = CURRENT_TIMESTAMP
+            """, (key, file_id))
+
+    def forget_file_id(self, key: str):
+        """Удалить file_id, который Telegram больше не принимает"""
+        conn = self.connections.get()
+        with conn:
+            conn.execute("DELETE FROM media_cache WHERE key = ?", (key,))
 
     def queue_valentine(self, sender_id: int, recipient_username: str, text: str,
                        image_template: int, is_anonymous: bool):
         """Добавить валентинку в очередь"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO queue (sender_id, recipient_username, text, image_template, is_anonymous)
-            VALUES (?, ?, ?, ?, ?)
-        """, (sender_id, recipient_username, text, image_template, is_anonymous))
-        
-        conn.commit()
-        conn.close()
+        conn = self.connections.get()
+        with conn:
+            conn.execute("""
+                INSERT INTO queue (sender_id, recipient_username, text, image_template, is_anonymous)
+                VALUES (?, ?, ?, ?, ?)
+            """, (sender_id, normalize_username(recipient_username), text, image_template, is_anonymous))
 
     def get_queued_valentines(self, recipient_username: str) -> List[Dict]:
         """Получить валентинки из очереди"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
+        conn = self.connections.get()
+        rows = conn.execute("""
             SELECT id, sender_id, text, image_template, is_anonymous FROM queue 
             WHERE recipient_username = ?
-        """, (recipient_username,))
-        rows = cursor.fetchall()
-        conn.close()
+        """, (normalize_username(recipient_username),)).fetchall()
         
         return [{"id": row[0], "sender_id": row[1], "text": row[2], 
                 "image_template": row[3], "is_anonymous": row[4]} for row in rows]
 
+    def claim_queued(self, recipient_username: str, limit: int = 50,
+                     claim_timeout: int = QUEUE_CLAIM_TIMEOUT) -> List[Dict]:
+        """
+        Забрать валентинки получателя из очереди на доставку
+
+        Одним запросом помечает до limit записей как выданные (claimed_at),
+        поэтому два одновременных /start не получат одну и ту же валентинку.
+        После отправки записи подтверждаются ack_queued, при ошибке - возвращаются
+        requeue_queued. Незавершенная выдача (например, бот упал) снова становится
+        доступна через claim_timeout секунд.
+        """
+        conn = self.connections.get()
+        with conn:
+            rows = conn.execute("""
+                UPDATE queue SET claimed_at = CURRENT_TIMESTAMP
+                WHERE id IN (
+                    SELECT id FROM queue
+                    WHERE recipient_username = ?
+                      AND (claimed_at IS NULL OR claimed_at <= datetime('now', ?))
+                    ORDER BY id
+                    LIMIT ?
+                )
+                RETURNING id, sender_id, text, image_template, is_anonymous
+            """, (normalize_username(recipient_username), f"-{int(claim_timeout)} seconds", limit)).fetchall()
+
+        # RETURNING не гарантирует порядок строк
+        rows.sort()
+        return [{"id": row[0], "sender_id": row[1], "text": row[2],
+                "image_template": row[3], "is_anonymous": row[4]} for row in rows]
+
+    def ack_queued(self, queue_ids: List[int]):
+        """Подтвердить доставку выданных валентинок (удалить из очереди)"""
+        conn = self.connections.get()
+        with conn:
+            conn.executemany("DELETE FROM queue WHERE id = ?", ((queue_id,) for queue_id in queue_ids))
+
+    def requeue_queued(self, queue_ids: List[int]):
+        """Вернуть выданные валентинки в очередь (доставка не удалась)"""
+        conn = self.connections.get()
+        with conn:
+            conn.executemany("UPDATE queue SET claimed_at = NULL WHERE id = ?",
+                             ((queue_id,) for queue_id in queue_ids))
+
     def remove_from_queue(self, queue_id: int):
         """Удалить валентинку из очереди"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM queue WHERE id = ?", (queue_id,))
-        conn.commit()
-        conn.close()
+        conn = self.connections.get()
+        with conn:
+            conn.execute("DELETE FROM queue WHERE id = ?", (queue_id,))
 
     def get_stats(self) -> Dict:
-        """Получить статистику"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM valentines WHERE delivered = 1")
-        delivered = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM queue")
-        in_queue = cursor.fetchone()[0]
-        
-        conn.close()
-        
+        """
+        Получить статистику (из счетчиков, без подсчета строк)
+
+        delivered - доставленные в рабочей базе, archived - перенесенные в архив;
+        всего доставлено delivered + archived.
+        """
+        self.flush()
+        conn = self.connections.get()
+        counters = dict(conn.execute("""
+            SELECT name, value FROM counters
+            WHERE name IN ('total_users', 'delivered', 'archived', 'in_queue', 'blocked_users')
+        """))
+
         return {
-            "total_users": total_users,
+            "total_users": counters.get("total_users", 0),
+            "delivered": counters.get("delivered", 0),
+            "archived": counters.get("archived", 0),
+            "in_queue": counters.get("in_queue", 0),
+            "blocked_users": counters.get("blocked_users", 0)
+        }
+
+    def get_throughput(self, minutes: int = 5) -> Dict:
+        """
+        Поминутная статистика за последние minutes минут (включая текущую)
+
+        Returns:
+            sent, new_users и delivered - сколько всего за период, *_per_minute -
+            в среднем за минуту, delivery_latency - средняя задержка доставки
+            через outbox в секундах (None, если доставок не было), queue_depth -
+            текущая глубина очереди
+        """
+        self.flush()
+        conn = self.connections.get()
+        since = f"-{int(minutes) - 1} minutes"
+        totals = dict(conn.execute("""
+            SELECT name, SUM(value) FROM counter_buckets
+            WHERE minute >= strftime('%Y-%m-%d %H:%M', 'now', ?)
+              AND name IN ('sent', 'new_users', 'delivered', 'delivery_latency_ms')
+            GROUP BY name
+        """, (since,)))
+        row = conn.execute("SELECT value FROM counters WHERE name = 'in_queue'").fetchone()
+
+        sent = totals.get("sent", 0)
+        new_users = totals.get("new_users", 0)
+        delivered = totals.get("delivered", 0)
+        return {
+            "minutes": minutes,
+            "sent": sent,
+            "new_users": new_users,
             "delivered": delivered,
-            "in_queue": in_queue
+            "sent_per_minute": sent / minutes,
+            "new_users_per_minute": new_users / minutes,
+            "delivered_per_minute": delivered / minutes,
+            "delivery_latency": totals.get("delivery_latency_ms", 0) / delivered / 1000 if delivered else None,
+            "queue_depth": row[0] if row else 0
         }
 
-    def get_all_users(self) -> List[int]:
-        """Получить ID всех пользователей"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM users")
-        users = [row[0] for row in cursor.fetchall()]
-        conn.close()
-        return users
\ No newline at end of file
+    def reconcile_counters(self):
+        """Пересчитать счетчики статистики с нуля (если они разошлись с данными)"""
+        self.flush()
+        conn = self.connections.get()
+        # ATTACH нельзя выполнить внутри транзакции, поэтому архив считаем заранее
+        archived = self._count_archived(conn)
+        with conn:
+            rebuild_counters(conn)
+            conn.execute("INSERT OR REPLACE INTO counters (name, value) VALUES ('archived', ?)", (archived,))
+
+    def prune_counter_buckets(self, keep_minutes: int = COUNTER_BUCKETS_KEEP_MINUTES):
+        """Удалить поминутную статистику старше keep_minutes минут"""
+        conn = self.connections.get()
+        with conn:
+            conn.execute("""
+                DELETE FROM counter_buckets WHERE minute < strftime('%Y-%m-%d %H:%M', 'now', ?)
+            """, (f"-{int(keep_minutes)} minutes",))
+
+    def get_all_users(self, include_blocked: bool = False) -> List[int]:
+        """Получить ID всех пользователей (по умолчанию без недоступных)"""
+        self.flush()
+        conn = self.connections.get()
+        sql = "SELECT user_id FROM users" if include_blocked else "SELECT user_id FROM users WHERE blocked = 0"
+        users = [row[0] for row in conn.execute(sql)]
+        return users
+
+    def record_delivery(self, user_id: int, error: Optional[str] = None, permanent: bool = False,
+                        max_failures: int = DELIVERY_MAX_FAILURES):
+        """
+        Запомнить результат отправки пользователю
+
+        Args:
+            error: текст ошибки, None - сообщение доставлено
+            permanent: пользователь недоступен насовсем (заблокировал бота, удален) -
+                сразу помечается blocked. Иначе blocked ставится после max_failures
+                неудачных отправок подряд. /start (add_user) снимает отметку.
+        """
+        conn = self.connections.get()
+        with conn:
+            if error is None:
+                # Обычно счетчик и так 0 - тогда строка не перезаписывается
+                conn.execute("""
+                    UPDATE users SET consecutive_failures = 0
+                    WHERE user_id = ? AND consecutive_failures > 0
+                """, (user_id,))
+                return
+
+            conn.execute("""
+                UPDATE users SET
+                    last_error = ?,
+                    last_error_at = CURRENT_TIMESTAMP,
+                    consecutive_failures = consecutive_failures + 1,
+                    blocked = CASE WHEN ? OR consecutive_failures + 1 >= ? THEN 1 ELSE blocked END
+                WHERE user_id = ?
+            """, (error, permanent, max_failures, user_id))
+
+    def create_broadcast(self, text: str, admin_chat_id: int, status_message_id: int,
+                         total: Optional[int] = None) -> int:
+        """Создать фоновую рассылку, вернуть её id"""
+        conn = self.connections.get()
+        with conn:
+            cursor = conn.execute("""
+                INSERT INTO broadcasts (text, admin_chat_id, status_message_id, total)
+                VALUES (?, ?, ?, ?)
+            """, (text, admin_chat_id, status_message_id, total))
+        return cursor.lastrowid
+
+    def get_broadcast(self, broadcast_id: int) -> Optional[Dict]:
+        """Получить рассылку по id"""
+        conn = self.connections.get()
+        row = conn.execute("""
+            SELECT id, text, status, cursor, sent, failed, total, admin_chat_id, status_message_id,
+                   created_at, updated_at
+            FROM broadcasts WHERE id = ?
+        """, (broadcast_id,)).fetchone()
+        return _broadcast_from_row(row) if row else None
+
+    def get_broadcasts(self, statuses: List[str]) -> List[Dict]:
+        """Рассылки в указанных статусах (running, paused, cancelled, done)"""
+        conn = self.connections.get()
+        rows = conn.execute(f"""
+            SELECT id, text, status, cursor, sent, failed, total, admin_chat_id, status_message_id,
+                   created_at, updated_at
+            FROM broadcasts WHERE status IN ({", ".join("?" * len(statuses))})
+        """, statuses).fetchall()
+        return sorted((_broadcast_from_row(row) for row in rows), key=lambda job: job["id"])
+
+    def set_broadcast_status(self, broadcast_id: int, status: str, only_from: Optional[List[str]] = None) -> bool:
+        """
+        Сменить статус рассылки
+
+        only_from - сменить, только если текущий статус из этого списка
+        (например, нельзя продолжить отмененную рассылку). Возвращает, сменился ли статус.
+        """
+        conn = self.connections.get()
+        sql = "UPDATE broadcasts SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?"
+        params = [status, broadcast_id]
+        if only_from:
+            sql += f" AND status IN ({', '.join('?' * len(only_from))})"
+            params += only_from
+        with conn:
+            return conn.execute(sql, params).rowcount > 0
+
+    def record_broadcast_result(self, broadcast_id: int, user_id: int, ok: bool):
+        """Отметить, что пользователю отправлено (или не удалось)"""
+        conn = self.connections.get()
+        with conn:
+            inserted = conn.execute("""
+                INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id, ok) VALUES (?, ?, ?)
+            """, (broadcast_id, user_id, ok)).rowcount
+            if inserted:
+                conn.execute(f"""
+                    UPDATE broadcasts SET {"sent = sent + 1" if ok else "failed = failed + 1"}
+                    WHERE id = ?
+                """, (broadcast_id,))
+
+    def advance_broadcast_cursor(self, broadcast_id: int, cursor: int):
+        """Сдвинуть курсор рассылки: все пользователи до cursor включительно обработаны"""
+        conn = self.connections.get()
+        with conn:
+            conn.execute("""
+                UPDATE broadcasts SET cursor = MAX(cursor, ?), updated_at = CURRENT_TIMESTAMP WHERE id = ?
+            """, (cursor, broadcast_id))
+            # Отметки до курсора больше не нужны
+            conn.execute("""
+                DELETE FROM broadcast_deliveries WHERE broadcast_id = ? AND user_id <= ?
+            """, (broadcast_id, cursor))
+
+    def get_broadcast_done_after(self, broadcast_id: int, cursor: int) -> set:
+        """Пользователи после курсора, которым рассылка уже отправлена (при продолжении)"""
+        conn = self.connections.get()
+        rows = conn.execute("""
+            SELECT user_id FROM broadcast_deliveries WHERE broadcast_id = ? AND user_id > ?
+        """, (broadcast_id, cursor))
+        return {row[0] for row in rows}
+
+    def _attach_archive(self, conn: sqlite3.Connection):
+        """Подключить архивную базу к соединению как схему archive"""
+        conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS archive.valentines (
+                id INTEGER PRIMARY KEY,
+                sender_id INTEGER,
+                recipient_id INTEGER,
+                recipient_username TEXT,
+                text TEXT,
+                image_template INTEGER,
+                is_anonymous BOOLEAN,
+                sent_at TIMESTAMP,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+    def archive_delivered(self, older_than_days: int = ARCHIVE_AFTER_DAYS,
+                          batch_size: int = ARCHIVE_BATCH_SIZE, max_batches: Optional[int] = None) -> int:
+        """
+        Перенести доставленные валентинки старше older_than_days дней в архивную базу
+
+        Переносит пачками по batch_size строк, каждая пачка - своя короткая
+        транзакция, чтобы не держать блокировку записи. Повторный запуск после
+        сбоя безопасен: уже перенесенные строки в архиве не дублируются.
+        Перенесенные строки уходят из счетчика delivered в счетчик archived.
+        Возвращает число перенесенных строк.
+        """
+        self.flush()
+        conn = self.connections.get()
+        cutoff = f"-{int(older_than_days)} days"
+        moved = 0
+        batches = 0
+
+        self._attach_archive(conn)
+        try:
+            while max_batches is None or batches < max_batches:
+                with conn:
+                    ids = [row[0] for row in conn.execute("""
+                        SELECT id FROM valentines
+                        WHERE delivered = 1 AND sent_at < datetime('now', ?)
+                        LIMIT ?
+                    """, (cutoff, batch_size))]
+                    if not ids:
+                        break
+
+                    placeholders = ", ".join("?" * len(ids))
+                    conn.execute(f"""
+                        INSERT OR IGNORE INTO archive.valentines
+                            (id, sender_id, recipient_id, recipient_username, text,
+                             image_template, is_anonymous, sent_at)
+                        SELECT id, sender_id, recipient_id, recipient_username, text,
+                               image_template, is_anonymous, sent_at
+                        FROM valentines WHERE id IN ({placeholders})
+                    """, ids)
+                    conn.execute(f"DELETE FROM valentines WHERE id IN ({placeholders})", ids)
+                    # Удаление уменьшает счетчик delivered, перенесенные учитываем в archived
+                    conn.execute("""
+                        INSERT INTO counters (name, value) VALUES ('archived', ?)
+                        ON CONFLICT (name) DO UPDATE SET value = value + excluded.value
+                    """, (len(ids),))
+
+                moved += len(ids)
+                batches += 1
+        finally:
+            conn.execute("DETACH DATABASE archive")
+
+        return moved
+
+    def vacuum(self, step_pages: int = VACUUM_STEP_PAGES, max_steps: int = VACUUM_MAX_STEPS,
+               pause: float = 0.05, allow_full: bool = False) -> int:
+        """
+        Вернуть системе свободные страницы базы небольшими шагами
+
+        Каждый шаг - PRAGMA incremental_vacuum(step_pages) в своей транзакции,
+        между шагами пауза, чтобы обработчики успевали писать.
+
+        Базы, созданные до включения auto_vacuum = INCREMENTAL, нужно один раз
+        перевести полным VACUUM: он блокирует всю базу на время перезаписи,
+        поэтому выполняется только с allow_full=True (при остановленном боте).
+        Возвращает число освобожденных страниц.
+        """
+        conn = self.connections.get()
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            if not allow_full:
+                print("⚠️ База создана без auto_vacuum = INCREMENTAL: место не освобождается. "
+                      "Остановите бота и запустите python archive_valentines.py --full-vacuum")
+                return 0
+            print("🗄 Перевод базы на auto_vacuum = INCREMENTAL (однократный полный VACUUM)")
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            return 0
+
+        start = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        free = start
+        for _ in range(max_steps):
+            if free == 0:
+                break
+            # execute() выполняет только первый шаг прагмы (одну страницу), executescript - всю
+            conn.executescript(f"PRAGMA incremental_vacuum({int(step_pages)});")
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            time.sleep(pause)
+        return start - free
+
+    def _count_archived(self, conn: sqlite3.Connection) -> int:
+        """Сколько валентинок в архивной базе (полный подсчет)"""
+        if not os.path.exists(self.archive_path):
+            return 0
+        self._attach_archive(conn)
+        try:
+            return conn.execute("SELECT COUNT(*) FROM archive.valentines").fetchone()[0]
+        finally:
+            conn.execute("DETACH DATABASE archive")
+
+    def get_archive_stats(self) -> Dict:
+        """Статистика по архиву (читает архивную базу, вызывать по запросу)"""
+        if not os.path.exists(self.archive_path):
+            return {"archived": 0, "first_sent_at": None, "last_sent_at": None}
+
+        conn = self.connections.get()
+        self._attach_archive(conn)
+        try:
+            row = conn.execute("SELECT COUNT(*), MIN(sent_at), MAX(sent_at) FROM archive.valentines").fetchone()
+        finally:
+            conn.execute("DETACH DATABASE archive")
+        return {"archived": row[0], "first_sent_at": row[1], "last_sent_at": row[2]}
+
+    def get_users_page(self, after_id: int = 0, limit: int = USERS_PAGE_SIZE,
+                       active_since: Optional[datetime] = None, exclude_blocked: bool = True) -> List[int]:
+        """
+        Страница ID пользователей по возрастанию user_id, начиная после after_id
+
+        Args:
+            active_since: только пользователи, заходившие в бота не раньше этого времени (UTC)
+            exclude_blocked: пропустить пользователей, заблокировавших бота
+        """
+        self.flush()
+        since = _format_timestamp(active_since)
+        conn = self.connections.get()
+        rows = conn.execute("""
+            SELECT user_id FROM users
+            WHERE user_id > ?
+              AND (? IS NULL OR last_seen_at >= ?)
+              AND (? = 0 OR blocked = 0)
+            ORDER BY user_id
+            LIMIT ?
+        """, (after_id, since, since, int(exclude_blocked), limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def iter_users(self, after_id: int = 0, page_size: int = USERS_PAGE_SIZE,
+                   active_since: Optional[datetime] = None, exclude_blocked: bool = True):
+        """
+        Перебрать ID пользователей страницами по page_size
+
+        Каждая страница - отдельный короткий запрос, транзакция между страницами
+        не держится. Чтобы продолжить прерванный перебор, передайте последний
+        полученный user_id в after_id.
+        """
+        while True:
+            page = self.get_users_page(after_id, page_size, active_since, exclude_blocked)
+            yield from page
+            if len(page) < page_size:
+                return
+            after_id = page[-1]
+
+    def estimate_users(self, active_since: Optional[datetime] = None) -> int:
+        """
+        Примерное число пользователей для отображения прогресса
+
+        Без фильтра по активности берется из счетчиков (без недоступных
+        пользователей), иначе считается по индексу last_seen_at.
+        """
+        if active_since is None:
+            stats = self.get_stats()
+            return stats["total_users"] - stats["blocked_users"]
+
+        conn = self.connections.get()
+        return conn.execute(
+            "SELECT COUNT(*) FROM users WHERE last_seen_at >= ?", (_format_timestamp(active_since),)
+        ).fetchone()[0]
+
+
+class AsyncDatabase:
+    """
+    Неблокирующая обертка над Database для async-обработчиков
+
+    Любой метод Database доступен как корутина: await async_db.get_stats().
+    Запись идет в одном отдельном потоке (писатель SQLite всегда один),
+    чтение - в небольшом пуле потоков (в WAL читатели не мешают писателю).
+    Число ожидающих запросов ограничено, у чтения есть таймаут.
+    """
+
+    # Методы, которые только читают: их можно выполнять параллельно.
+    # Всё остальное считается записью и выполняется строго по очереди.
+    READ_METHODS = {
+        "get_user_by_username",
+        "resolve_usernames",
+        "get_user_cache_stats",
+        "get_queued_valentines",
+        "get_stats",
+        "get_throughput",
+        "get_all_users",
+        "get_users_page",
+        "estimate_users",
+        "get_broadcast",
+        "get_broadcasts",
+        "get_broadcast_done_after",
+        "get_outbox_stats",
+        "get_prerender_batch",
+        "get_file_id",
+    }
+
+    def __init__(self, db: Database, read_workers: int = DB_READ_WORKERS,
+                 max_pending: int = DB_QUEUE_SIZE, timeout: float = DB_TIMEOUT):
+        self.db = db
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="db-reader")
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def __getattr__(self, name: str):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+
+        executor = self._readers if name in self.READ_METHODS else self._writer
+
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            return await self._run(executor, functools.partial(method, *args, **kwargs))
+
+        return call
+
+    async def iter_users(self, after_id: int = 0, page_size: int = USERS_PAGE_SIZE,
+                         active_since: Optional[datetime] = None, exclude_blocked: bool = True):
+        """Асинхронный вариант Database.iter_users: страницы читаются в пуле потоков"""
+        while True:
+            page = await self.get_users_page(after_id, page_size, active_since, exclude_blocked)
+            for user_id in page:
+                yield user_id
+            if len(page) < page_size:
+                return
+            after_id = page[-1]
+
+    async def _run(self, executor: ThreadPoolExecutor, func):
+        """
+        Выполнить запрос в потоке с ограничением очереди и таймаутом
+
+        Таймаут есть только у чтения. Запись после таймаута все равно
+        выполнилась бы в потоке, и вызывающий, решив, что она не прошла,
+        повторил бы ее (дубль валентинки) - поэтому запись всегда дожидается
+        результата.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+
+        # Если очередь запросов заполнена, ждем свободное место не дольше таймаута
+        await asyncio.wait_for(self._slots.acquire(), timeout=self.timeout)
+        loop = asyncio.get_running_loop()
+        try:
+            future = loop.run_in_executor(executor, func)
+        except BaseException:
+            self._slots.release()
+            raise
+        # Слот освобождается, только когда запрос действительно выполнился в потоке
+        future.add_done_callback(self._release_slot)
+
+        if executor is self._writer:
+            # Отмена вызывающего не прерывает запись: она доходит до конца в потоке
+            return await asyncio.shield(future)
+        return await asyncio.wait_for(asyncio.shield(future), timeout=self.timeout)
+
+    def _release_slot(self, future: asyncio.Future):
+        # Ошибку запроса, брошенного по таймауту, забираем, чтобы asyncio не предупреждал
+        if not future.cancelled():
+            future.exception()
+        self._slots.release()
+
+    def shutdown(self):
+        """Дождаться выполнения запросов и остановить потоки"""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
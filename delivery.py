@@ -0,0 +1,339 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from config import (
+    DELIVERY_WORKERS, DELIVERY_BATCH_SIZE, DELIVERY_POLL_INTERVAL, DELIVERY_MAX_ATTEMPTS,
+    DELIVERY_RETRY_BASE, DELIVERY_RETRY_MAX, DELIVERY_RELEASE_AT, PRERENDER_PATH, PRERENDER_BATCH_SIZE,
+    PREVIEW_TEXT
+)
+from telegram.error import BadRequest
+
+from broadcast import Broadcaster, DEAD_CHAT_ERRORS, classify_error, record_delivery
+from render_service import render_service
+from utils2 import ImageProcessor, format_sender_info
+
+
+def parse_release_at(value: str) -> Optional[datetime]:
+    """Время выпуска из конфига (местное время сервера) -> datetime в UTC без tzinfo"""
+    if not value:
+        return None
+    local = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    return local.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def sender_name(valentine: dict) -> str:
+    return valentine["sender_first_name"] or valentine["sender_username"] or "Unknown"
+
+
+def format_valentine(valentine: dict) -> str:
+    """Текст послания для получателя (подпись к картинке или сообщение)"""
+    sender_info = format_sender_info(valentine["sender_id"], sender_name(valentine), valentine["is_anonymous"])
+    if valentine["image_template"]:
+        return f"💌 Вам пришло послание!\n\n{sender_info}"
+    return f"💌 Вам пришло послание!\n\n{valentine['text']}\n\n{sender_info}"
+
+
+def retry_delay(attempts: int, base: float = DELIVERY_RETRY_BASE, limit: float = DELIVERY_RETRY_MAX) -> float:
+    """Пауза перед следующей попыткой: base * 2^(attempts - 1), но не больше limit"""
+    return min(base * 2 ** (attempts - 1), limit)
+
+
+async def send_cached_photo(bot, async_db, chat_id: int, key: str, load_photo, **kwargs):
+    """
+    Отправить картинку по file_id из кэша, а если его нет - загрузить и запомнить
+
+    key - хэш содержимого (ImageProcessor.media_key), load_photo() - корутина,
+    которая возвращает картинку для загрузки (bytes или файл). Остальные
+    аргументы передаются в bot.send_photo.
+    """
+    file_id = await async_db.get_file_id(key)
+    if file_id is not None:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            if any(text in str(e).lower() for text in DEAD_CHAT_ERRORS):
+                raise
+            # file_id больше не принимается - загружаем картинку заново
+            print(f"⚠️ Не удалось отправить картинку по file_id, загружаем заново: {e}")
+            await async_db.forget_file_id(key)
+
+    message = await bot.send_photo(chat_id=chat_id, photo=await load_photo(), **kwargs)
+    if message is not None and message.photo:
+        await async_db.save_file_id(key, message.photo[-1].file_id)
+    return message
+
+
+async def send_template_preview(bot, async_db, chat_id: int, template_id: int, text: str = PREVIEW_TEXT,
+                                **kwargs):
+    """
+    Превью шаблона для выбора (choose_template)
+
+    По умолчанию - общее превью с PREVIEW_TEXT: рисуется и загружается один
+    раз, дальше отправляется по file_id. Превью с текстом пользователя
+    кэшируется так же, по этому тексту.
+    """
+    async def load_photo():
+        result = await render_service.render(template_id, text, preview=True)
+        if not result["success"]:
+            raise RuntimeError(result["error"])
+        return result["buffer"]
+
+    key = ImageProcessor.media_key(template_id, text, preview=True)
+    return await send_cached_photo(bot, async_db, chat_id, key, load_photo, **kwargs)
+
+
+class ClaimLost(Exception):
+    """Валентинку, пока она ждала отправки, выдали другому воркеру"""
+
+
+class DeliveryService:
+    """
+    Фоновая доставка валентинок (outbox)
+
+    Обработчик только сохраняет валентинку в статусе pending
+    (Database.enqueue_valentine) и сразу отвечает отправителю. Воркеры забирают
+    пачки из outbox, рендерят картинки, отправляют и отмечают результат:
+    delivered, повтор с нарастающей паузой при временной ошибке или failed,
+    если получатель недоступен или попытки кончились. Медленный Telegram
+    задерживает только доставку, но не отправителей. Пачки отправляются
+    параллельно, до Broadcaster.concurrency отправок сразу на все воркеры.
+
+    Валентинки, отправленные до времени выпуска (release_at), ждут его в
+    outbox. Пока доставлять нечего, картинки к ним рисуются заранее и
+    сохраняются в PRERENDER_PATH, поэтому в момент выпуска остается только
+    отправка - с максимальной скоростью, в порядке времени выпуска.
+    """
+
+    def __init__(self, async_db, broadcaster: Optional[Broadcaster] = None,
+                 workers: int = DELIVERY_WORKERS, batch_size: int = DELIVERY_BATCH_SIZE,
+                 poll_interval: float = DELIVERY_POLL_INTERVAL, max_attempts: int = DELIVERY_MAX_ATTEMPTS,
+                 release_at: Optional[datetime] = parse_release_at(DELIVERY_RELEASE_AT),
+                 prerender_path: str = PRERENDER_PATH, prerender_batch_size: int = PRERENDER_BATCH_SIZE):
+        self.db = async_db
+        # Лимит скорости общий с рассылками, если передан тот же Broadcaster
+        self.broadcaster = broadcaster or Broadcaster()
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.release_at = release_at
+        self.prerender_path = prerender_path
+        self.prerender_batch_size = prerender_batch_size
+        self.bot = None
+        self.stats = {"delivered": 0, "retried": 0, "failed": 0, "prerendered": 0}
+        self._tasks = []
+        self._last_busy = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._stopping = False
+
+    def start(self, bot):
+        """Запустить воркеров (при старте бота)"""
+        if self._tasks:
+            return
+        self.bot = bot
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        # Одновременных отправок - столько же, сколько в рассылках (BROADCAST_CONCURRENCY)
+        self._slots = asyncio.Semaphore(self.broadcaster.concurrency)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._prerenderer()))
+
+    async def stop(self):
+        """
+        Остановить воркеров, дав им дослать начатые пачки
+
+        Недоставленные валентинки остаются в outbox и будут доставлены после
+        перезапуска.
+        """
+        self._stopping = True
+        self.notify()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, sender_id: int, recipient_id: int, recipient_username: str, text: str,
+                     image_template: Optional[int], is_anonymous: bool,
+                     release_at: Optional[datetime] = None) -> int:
+        """
+        Поставить валентинку в outbox и разбудить воркеров
+
+        release_at (UTC) - время выпуска для этого послания; по умолчанию общее
+        из конфига, если оно еще не наступило, иначе доставка сразу.
+        """
+        if release_at is None and self.release_at is not None and datetime.utcnow() < self.release_at:
+            release_at = self.release_at
+        valentine_id = await self.db.enqueue_valentine(
+            sender_id, recipient_id, recipient_username, text, image_template, is_anonymous, release_at
+        )
+        self.notify()
+        return valentine_id
+
+    def notify(self):
+        """Разбудить воркеров: в outbox появилась новая валентинка"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _wait(self):
+        """Ждать новую валентинку, но не дольше poll_interval (на случай повторов по времени)"""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _worker(self):
+        while not self._stopping:
+            try:
+                batch = await self.db.claim_outbox(self.batch_size)
+            except Exception as e:
+                print(f"❌ Не удалось забрать валентинки из outbox: {e}")
+                batch = []
+
+            if not batch:
+                await self._wait()
+                continue
+
+            self._last_busy = time.monotonic()
+            # Пачка уходит параллельно: скорость ограничивает лимит Broadcaster, а не число воркеров
+            await asyncio.gather(*(self._deliver_limited(valentine) for valentine in batch))
+
+    async def _deliver_limited(self, valentine: dict):
+        """Доставить одну валентинку, заняв один из общих слотов отправки"""
+        async with self._slots:
+            try:
+                await self._deliver(valentine)
+            except Exception as e:
+                # Запись остается в sending и будет выдана снова после OUTBOX_CLAIM_TIMEOUT
+                print(f"❌ Ошибка доставки валентинки #{valentine['id']}: {e}")
+
+    async def _prerenderer(self):
+        """Рисовать картинки отложенных валентинок, пока воркерам нечего доставлять"""
+        os.makedirs(self.prerender_path, exist_ok=True)
+        while not self._stopping:
+            batch = []
+            if time.monotonic() - self._last_busy >= self.poll_interval:
+                try:
+                    batch = await self.db.get_prerender_batch(self.prerender_batch_size)
+                except Exception as e:
+                    print(f"❌ Не удалось получить валентинки для отрисовки: {e}")
+
+            if not batch:
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            for valentine in batch:
+                if self._stopping:
+                    return
+                try:
+                    await self._prerender(valentine)
+                except Exception as e:
+                    print(f"❌ Не удалось заранее отрисовать валентинку #{valentine['id']}: {e}")
+
+    @staticmethod
+    async def _render(valentine: dict) -> dict:
+        return await render_service.render(valentine["image_template"], valentine["text"], sender_name(valentine))
+
+    async def _prerender(self, valentine: dict):
+        result = await self._render(valentine)
+        if not result["success"]:
+            # Нарисуем при доставке
+            print(f"⚠️ Валентинка #{valentine['id']} не отрисована заранее: {result['error']}")
+            return
+
+        extension = os.path.splitext(result["buffer"].name)[1]
+        path = os.path.join(self.prerender_path, f"valentine_{valentine['id']}{extension}")
+        with open(path + ".tmp", "wb") as f:
+            f.write(result["buffer"].getvalue())
+        os.replace(path + ".tmp", path)
+
+        if await self.db.set_rendered_path(valentine["id"], path):
+            self.stats["prerendered"] += 1
+        else:
+            # Валентинку уже забрали на отправку и рисуют при доставке
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path: Optional[str]):
+        if path:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    async def _deliver(self, valentine: dict):
+        caption = format_valentine(valentine)
+
+        async def send_text(chat_id):
+            await self.bot.send_message(chat_id=chat_id, text=caption)
+
+        if not valentine["image_template"]:
+            send = send_text
+        else:
+            key = ImageProcessor.media_key(valentine["image_template"], valentine["text"])
+            path = valentine["rendered_path"]
+            if path and not os.path.exists(path):
+                path = None
+
+            # Рисуем, только если такой картинки еще нет ни в Telegram, ни на диске
+            buffer = None
+            if path is None and await self.db.get_file_id(key) is None:
+                result = await self._render(valentine)
+                if not result["success"]:
+                    await self._failed(valentine, f"render: {result['error']}", permanent=False)
+                    return
+                buffer = result["buffer"]
+
+            async def load_photo():
+                if path is not None:
+                    with open(path, "rb") as f:
+                        return f.read()
+                if buffer is not None:
+                    return buffer.getvalue()
+                # Кэшированный file_id устарел, а картинки под рукой нет
+                result = await self._render(valentine)
+                if not result["success"]:
+                    raise RuntimeError(result["error"])
+                return result["buffer"].getvalue()
+
+            async def send_image(chat_id):
+                await send_cached_photo(self.bot, self.db, chat_id, key, load_photo, caption=caption)
+
+            send = send_image
+
+        async def send_claimed(chat_id):
+            # Подтверждаем выдачу уже после ожидания лимита, прямо перед отправкой:
+            # если за это время валентинку забрал другой воркер, отправит он
+            if not await self.db.touch_claim(valentine["id"], valentine["claim_token"]):
+                raise ClaimLost()
+            await send(chat_id)
+
+        error = await self.broadcaster.send(valentine["recipient_id"], send_claimed)
+        if isinstance(error, ClaimLost):
+            print(f"⚠️ Валентинка #{valentine['id']} уже отправляется другим воркером")
+            return
+        await record_delivery(self.db, valentine["recipient_id"], error)
+
+        if error is None:
+            if await self.db.mark_delivered(valentine["id"], valentine["claim_token"]):
+                self.stats["delivered"] += 1
+                self._remove(valentine["rendered_path"])
+            return
+
+        kind, permanent = classify_error(error)
+        await self._failed(valentine, f"{kind or 'network'}: {error}", permanent)
+
+    async def _failed(self, valentine: dict, error: str, permanent: bool):
+        if permanent or valentine["attempts"] >= self.max_attempts:
+            if await self.db.mark_failed(valentine["id"], valentine["claim_token"], error):
+                self.stats["failed"] += 1
+                self._remove(valentine["rendered_path"])
+                print(f"❌ Валентинка #{valentine['id']} не доставлена: {error}")
+            return
+
+        delay = retry_delay(valentine["attempts"])
+        if await self.db.mark_failed(valentine["id"], valentine["claim_token"], error, retry_in=delay):
+            self.stats["retried"] += 1
+            print(f"⏳ Валентинка #{valentine['id']}: повтор через {delay:.0f} с ({error})")
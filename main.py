@@ -12,7 +12,11 @@ from handlers import (
     back_to_menu, copy_invite_link, share_invite,
     CHOOSE_MODE, CHOOSE_RECIPIENT, ENTER_TEXT, CHOOSE_TEMPLATE, CHOOSE_ANONYMOUS
 )
-from admin_panel import admin_panel, broadcast_message, process_broadcast, admin_back
+from admin_panel import (
+    admin_panel, admin_stats, broadcast_message, process_broadcast, admin_back, reconcile_stats,
+    broadcast_control, admin_broadcasts, db, async_db, broadcasts, deliveries
+)
+from render_service import render_service
 
 # Настройка логирования
 logging.basicConfig(
@@ -25,6 +29,18 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+async def on_startup(app: Application):
+    """Продолжить фоновые рассылки и доставку валентинок, прерванные прошлой остановкой бота"""
+    await broadcasts.start(app.bot)
+    deliveries.start(app.bot)
+
+
+async def on_shutdown(app: Application):
+    """Остановить фоновые рассылки и доставку (они продолжатся при следующем запуске)"""
+    await deliveries.stop()
+    await broadcasts.stop()
+
+
 def main():
     """Запуск бота ПочтИИИ"""
     
@@ -48,9 +64,20 @@ def main():
     print(f"👤 ADMIN_ID: {ADMIN_ID if ADMIN_ID != 0 else 'не установлен'}")
     
     # Создаем приложение
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(on_startup)
+        .post_stop(on_shutdown)
+        .build()
+    )
     print("✅ Приложение создано")
 
+    # Пул процессов для рендера картинок, чтобы не блокировать обработку обновлений.
+    # Шаблоны и шрифты прогреваются в самих процессах пула (_init_worker)
+    render_service.start()
+    print("✅ Пул рендера запущен")
+
     # Диалог отправки послания
     valentine_conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(send_valentine_start, pattern="send_valentine")],
@@ -91,7 +118,11 @@ def main():
     app.add_handler(CallbackQueryHandler(share_invite, pattern="share_invite"))
     app.add_handler(CallbackQueryHandler(back_to_menu, pattern="back_to_menu"))
     app.add_handler(CallbackQueryHandler(admin_panel, pattern="admin_panel"))
+    app.add_handler(CallbackQueryHandler(admin_stats, pattern="admin_stats"))
     app.add_handler(CallbackQueryHandler(broadcast_message, pattern="admin_broadcast"))
+    app.add_handler(CallbackQueryHandler(admin_broadcasts, pattern="admin_jobs"))
+    app.add_handler(CallbackQueryHandler(broadcast_control, pattern=r"bc_(pause|resume|cancel|status)_\d+$"))
+    app.add_handler(CallbackQueryHandler(reconcile_stats, pattern="admin_reconcile"))
     app.add_handler(CallbackQueryHandler(admin_back, pattern="admin_back"))
 
     # Inline режим
@@ -123,6 +154,10 @@ def main():
     except Exception as e:
         print(f"\n❌ Ошибка: {e}")
         return
+    finally:
+        render_service.shutdown()
+        async_db.shutdown()
+        db.close()
 
 
 if __name__ == '__main__':
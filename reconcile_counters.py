@@ -0,0 +1,27 @@
+"""
+Пересчет счетчиков статистики
+
+Запуск: python reconcile_counters.py
+
+Пересчитывает таблицу counters (и поминутную статистику) по users,
+valentines и queue. Нужен, если счетчики разошлись с данными, например
+после ручной правки базы. То же делает кнопка «Пересчитать статистику»
+в панели администратора.
+"""
+from database import Database
+
+
+def main():
+    db = Database()
+    before = db.get_stats()
+    db.reconcile_counters()
+    after = db.get_stats()
+    db.close()
+
+    for name, value in after.items():
+        mark = "✅" if before[name] == value else "🔄"
+        print(f"{mark} {name}: {before[name]} -> {value}")
+
+
+if __name__ == '__main__':
+    main()
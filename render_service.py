@@ -0,0 +1,221 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from config import (
+    RENDER_WORKERS, RENDER_QUEUE_SIZE, RENDER_TIMEOUT, RENDER_BATCH_SIZE, RENDER_FORMAT, RENDER_QUALITY
+)
+from utils2 import ImageProcessor
+
+
+def _init_worker():
+    """Прогрев кэшей шаблонов и шрифтов в процессе-воркере"""
+    ImageProcessor.preload_templates()
+    for size in range(60, 18, -2):
+        try:
+            ImageProcessor.get_font(size)
+        except Exception as e:
+            print(f"⚠️ Не удалось загрузить шрифт размера {size}: {e}")
+            break
+
+
+def _to_bytes(result: dict) -> dict:
+    """Буфер с картинкой -> байты, чтобы результат можно было передать между процессами"""
+    buffer = result.pop("buffer")
+    if buffer is not None:
+        result["data"] = buffer.getvalue()
+        result["name"] = buffer.name
+    return result
+
+
+def _from_bytes(result: dict) -> dict:
+    """Обратно к виду create_valentine(in_memory=True): байты -> BytesIO в buffer"""
+    data = result.pop("data", None)
+    name = result.pop("name", None)
+    result["buffer"] = None
+    if data is not None:
+        buffer = BytesIO(data)
+        buffer.name = name
+        result["buffer"] = buffer
+    return result
+
+
+def _render(template_id: int, text: str, sender_name: str, image_format: str, quality: int,
+            preview: bool = False) -> dict:
+    """Рендер в воркере: картинка возвращается байтами"""
+    return _to_bytes(ImageProcessor.create_valentine(
+        template_id, text, sender_name,
+        in_memory=True, image_format=image_format, quality=quality, preview=preview
+    ))
+
+
+def _render_many(items: List[Dict], image_format: str, quality: int) -> List[dict]:
+    """Рендер пачки в воркере: результаты в порядке items"""
+    results = [None] * len(items)
+    for index, _, result in ImageProcessor.render_many(items, in_memory=True,
+                                                       image_format=image_format, quality=quality):
+        results[index] = _to_bytes(result)
+    return results
+
+
+class RenderService:
+    """
+    Рендер посланий в пуле процессов
+
+    Картинки рисуются в отдельных процессах, поэтому event loop бота не
+    блокируется, а рендер масштабируется на все ядра.
+    """
+
+    def __init__(self, workers: int = RENDER_WORKERS, max_pending: int = RENDER_QUEUE_SIZE,
+                 timeout: float = RENDER_TIMEOUT, batch_size: int = RENDER_BATCH_SIZE):
+        self.workers = workers or None  # 0 - по числу ядер
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def start(self):
+        """Запустить пул процессов"""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+
+    def shutdown(self, wait: bool = True):
+        """Остановить пул процессов"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    @staticmethod
+    def _error(error: str, message: str) -> dict:
+        return {
+            "success": False,
+            "path": None,
+            "buffer": None,
+            "error": error,
+            "message": message
+        }
+
+    async def _call(self, func, *args, timeout: Optional[float] = None) -> Tuple[Optional[object], Optional[dict]]:
+        """
+        Выполнить func(*args) в пуле: (результат, None) или (None, словарь с ошибкой)
+
+        Число задач в пуле ограничено max_pending, у каждой есть таймаут
+        (по умолчанию self.timeout).
+        """
+        timeout = timeout or self.timeout
+        self.start()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+
+        # Ограничиваем число задач в очереди: если пул перегружен, ждем не дольше таймаута
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            return None, self._error(
+                "Очередь рендера переполнена",
+                "⏳ Сейчас очень много посланий! Попробуйте через минуту."
+            )
+
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            future = loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool as e:
+            # Пул сломался еще до этой задачи
+            self._slots.release()
+            return None, self._restart(executor, e)
+        except BaseException:
+            self._slots.release()
+            raise
+        # Слот освобождается, только когда рендер действительно закончился: после
+        # таймаута задача продолжает занимать процесс пула
+        future.add_done_callback(self._release_slot)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=timeout), None
+        except asyncio.TimeoutError:
+            print(f"❌ Рендер послания не уложился в {timeout} с")
+            return None, self._error(
+                f"Превышено время рендера ({timeout} с)",
+                "⚠️ Не удалось создать картинку вовремя. Попробуйте еще раз."
+            )
+        except BrokenProcessPool as e:
+            return None, self._restart(executor, e)
+
+    def _restart(self, executor, error: BrokenProcessPool) -> dict:
+        """Воркер упал - пересоздаем пул для следующих задач"""
+        print(f"❌ Пул рендера сломан, перезапускаем: {error}")
+        if self._executor is executor:
+            self.shutdown(wait=False)
+            self.start()
+        return self._error(str(error), "⚠️ Ошибка при создании послания. Попробуйте еще раз.")
+
+    async def render(self, template_id: int, text: str, sender_name: str = "Unknown",
+                     image_format: str = RENDER_FORMAT, quality: int = RENDER_QUALITY,
+                     preview: bool = False) -> dict:
+        """
+        Отрендерить послание, не блокируя event loop
+
+        preview - быстрое уменьшенное превью, как в ImageProcessor.create_valentine
+
+        Returns:
+            тот же словарь, что и ImageProcessor.create_valentine(in_memory=True)
+        """
+        result, error = await self._call(_render, template_id, text, sender_name, image_format, quality, preview)
+        return error if error else _from_bytes(result)
+
+    async def render_many(self, items: List[Dict], image_format: str = RENDER_FORMAT,
+                          quality: int = RENDER_QUALITY) -> AsyncIterator[Tuple[int, dict]]:
+        """
+        Отрендерить пачку посланий в пуле, не блокируя event loop
+
+        Послания группируются по шаблону и режутся на части по batch_size:
+        каждая часть - одна задача пула (шаблон и шрифты берутся один раз),
+        части рисуются параллельно. Таймаут части - timeout на каждое послание.
+
+        Args:
+            items: словари с ключами "image_template" и "text", опционально "sender_name"
+
+        Yields:
+            (индекс в items, результат как у render) - по мере готовности частей,
+            как у ImageProcessor.render_many
+        """
+        groups = {}
+        for index, item in enumerate(items):
+            groups.setdefault(item["image_template"], []).append(index)
+        chunks = [
+            indexes[start:start + self.batch_size]
+            for indexes in groups.values()
+            for start in range(0, len(indexes), self.batch_size)
+        ]
+
+        async def render_chunk(indexes):
+            jobs = [
+                {key: items[i][key] for key in ("image_template", "text", "sender_name") if key in items[i]}
+                for i in indexes
+            ]
+            results, error = await self._call(_render_many, jobs, image_format, quality,
+                                              timeout=self.timeout * len(indexes))
+            return indexes, results, error
+
+        tasks = [asyncio.ensure_future(render_chunk(indexes)) for indexes in chunks]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                indexes, results, error = await next_done
+                for position, index in enumerate(indexes):
+                    yield index, dict(error) if error else _from_bytes(results[position])
+        finally:
+            # Потребитель остановился раньше - не ждем оставшиеся части
+            for task in tasks:
+                task.cancel()
+
+    def _release_slot(self, future: asyncio.Future):
+        # Ошибку рендера, брошенного по таймауту, забираем, чтобы asyncio не предупреждал
+        if not future.cancelled():
+            future.exception()
+        self._slots.release()
+
+render_service = RenderService()
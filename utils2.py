@@ -1,9 +1,249 @@
 from PIL import Image, ImageDraw, ImageFont
 from textwrap import wrap
-from config import TEMPLATES_PATH, FONTS_PATH, MAX_TEXT_LENGTH
+from config import (
+    TEMPLATES_PATH, FONTS_PATH, MAX_TEXT_LENGTH, TEMPLATE_CACHE_MAX_MB, LAYOUT_CACHE_SIZE,
+    RENDER_FORMAT, RENDER_QUALITY, RENDER_PNG_COMPRESS_LEVEL, PREVIEW_MAX_SIDE, PREVIEW_QUALITY,
+    TEMPLATES_MANIFEST
+)
+from collections import OrderedDict
+from functools import lru_cache
+from io import BytesIO
+from typing import Optional, Dict, Iterable, Iterator, Tuple
+import hashlib
+import json
+import mmap
 import os
+import threading
+import weakref
 from datetime import datetime
 
+
+class TemplateCache:
+    """
+    Кэш декодированных и затемнённых шаблонов
+    
+    Каждый шаблон открывается, декодируется и затемняется один раз на процесс.
+    Если файл шаблона изменился (другой mtime), он перезагружается.
+    Для превью рядом хранятся уменьшенные копии.
+    При превышении лимита памяти вытесняются давно не использованные шаблоны.
+    
+    Собранные build_templates.py шаблоны (уже затемнённые сырые пиксели)
+    не декодируются: пиксели читаются из файла через mmap.
+    """
+    
+    def __init__(self, max_bytes: int, darkness_level: float = 0.3):
+        self.max_bytes = max_bytes
+        self.darkness_level = darkness_level
+        self._entries = OrderedDict()  # (path, max_side) -> (mtime, image, size_bytes, full_size)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.raw_assets = {}  # путь к собранному шаблону -> (mode, (width, height))
+    
+    @staticmethod
+    def _image_bytes(img) -> int:
+        """Примерный объем памяти, занимаемый изображением"""
+        return img.width * img.height * len(img.getbands())
+    
+    def _load(self, path: str):
+        """Открыть и затемнить шаблон"""
+        raw = self.raw_assets.get(path)
+        if raw is not None:
+            # Собранный шаблон: пиксели уже затемнены, читаем их без декодирования
+            mode, size = raw
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return Image.frombuffer(mode, size, data, "raw", mode, 0, 1)
+        
+        with Image.open(path) as src:
+            src.load()
+            return ImageProcessor.darken_image(src, darkness_level=self.darkness_level)
+    
+    def _load_preview(self, path: str, max_side: int):
+        """Уменьшенная копия затемнённого шаблона (длинная сторона не больше max_side)"""
+        full = self.get(path)
+        scale = min(1.0, max_side / max(full.size))
+        size = (max(1, round(full.width * scale)), max(1, round(full.height * scale)))
+        return full.resize(size, Image.BILINEAR, reducing_gap=2.0), full.size
+    
+    def get(self, path: str, max_side: Optional[int] = None):
+        """
+        Получить затемнённый шаблон
+        
+        Возвращает общий объект из кэша - перед рисованием на нём нужно сделать copy().
+        Бросает FileNotFoundError, если файла нет.
+        
+        Args:
+            path: путь к файлу шаблона
+            max_side: если задан - уменьшенная копия для превью
+        """
+        return self.get_with_size(path, max_side)[0]
+    
+    def get_with_size(self, path: str, max_side: Optional[int] = None) -> tuple:
+        """То же, что get, но вместе с размером исходного шаблона: (image, (width, height))"""
+        mtime = os.stat(path).st_mtime
+        key = (path, max_side)
+        
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == mtime:
+                self._entries.move_to_end(key)
+                return entry[1], entry[3]
+        
+        # Декодируем вне блокировки, чтобы не задерживать другие шаблоны
+        if max_side is None:
+            img = self._load(path)
+            full_size = img.size
+        else:
+            img, full_size = self._load_preview(path, max_side)
+        size = self._image_bytes(img)
+        
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total_bytes -= old[2]
+            self._entries[key] = (mtime, img, size, full_size)
+            self._total_bytes += size
+            
+            # Вытесняем самые старые шаблоны, пока не уложимся в лимит
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, _, evicted_size, _) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_size
+        
+        return img, full_size
+    
+    def preload(self, paths, max_side: Optional[int] = None):
+        """Загрузить шаблоны заранее (при старте бота)"""
+        for path in paths:
+            try:
+                self.get(path, max_side)
+            except Exception as e:
+                print(f"⚠️ Не удалось загрузить шаблон {path}: {e}")
+    
+    def clear(self):
+        """Очистить кэш"""
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+
+class FontMetrics:
+    """
+    Таблица метрик глифов для одного размера шрифта
+    
+    Каждое слово измеряется один раз, ширина строки получается сложением
+    ширин слов, пробелов и кернинга на стыках. Результат совпадает с
+    font.getbbox(line), но без повторной растеризации целых строк.
+    """
+    
+    _by_font = weakref.WeakKeyDictionary()
+    
+    def __init__(self, font):
+        self.font = font
+        self.space_advance = font.getlength(' ')
+        self._glyphs = {}   # символ -> (advance, left, top, right, bottom)
+        self._words = {}    # слово -> advance с учетом кернинга внутри слова
+        self._kerning = {}  # (символ, символ) -> поправка кернинга
+    
+    @classmethod
+    def of(cls, font) -> "FontMetrics":
+        """Получить (или создать) таблицу метрик для объекта шрифта"""
+        metrics = cls._by_font.get(font)
+        if metrics is None:
+            metrics = cls(font)
+            cls._by_font[font] = metrics
+        return metrics
+    
+    def glyph(self, char: str) -> tuple:
+        """Метрики одного символа: (advance, left, top, right, bottom)"""
+        info = self._glyphs.get(char)
+        if info is None:
+            left, top, right, bottom = self.font.getbbox(char)
+            info = (self.font.getlength(char), left, top, right, bottom)
+            self._glyphs[char] = info
+        return info
+    
+    def word_advance(self, word: str) -> float:
+        """Ширина слова по advance (кернинг внутри слова учтен)"""
+        advance = self._words.get(word)
+        if advance is None:
+            advance = self.font.getlength(word)
+            self._words[word] = advance
+        return advance
+    
+    def kerning(self, left: str, right: str) -> float:
+        """Поправка кернинга для пары символов"""
+        pair = (left, right)
+        value = self._kerning.get(pair)
+        if value is None:
+            value = self.font.getlength(left + right) - self.glyph(left)[0] - self.glyph(right)[0]
+            self._kerning[pair] = value
+        return value
+    
+    def join_advance(self, line_advance: float, last_word: str, word: str) -> float:
+        """Advance строки после добавления к ней слова через пробел"""
+        if not last_word:
+            return self.word_advance(word)
+        return (line_advance
+                + self.kerning(last_word[-1], ' ') + self.space_advance + self.kerning(' ', word[0])
+                + self.word_advance(word))
+    
+    def ink_width(self, advance: float, first_char: str, last_char: str) -> float:
+        """Ширина строки так, как её считает getbbox: от начала/края глифа до advance/края"""
+        last_advance, _, _, last_right, _ = self.glyph(last_char)
+        first_left = self.glyph(first_char)[1]
+        return max(advance, advance - last_advance + last_right) - min(0, first_left)
+    
+    def line_advance(self, line: str) -> float:
+        """Advance произвольной строки из слов, разделенных пробелами"""
+        advance = 0
+        last_word = ""
+        for word in line.split(' '):
+            if not word:
+                # Повторный пробел: слово нулевой ширины
+                advance += self.space_advance
+                continue
+            advance = self.join_advance(advance, last_word, word)
+            last_word = word
+        return advance
+    
+    def line_width(self, line: str) -> float:
+        """Ширина строки (как bbox[2] - bbox[0])"""
+        if not line:
+            return 0
+        return self.ink_width(self.line_advance(line), line[0], line[-1])
+    
+    def line_height(self, line: str) -> int:
+        """Высота строки (как bbox[3] - bbox[1]) по верхним и нижним краям глифов"""
+        if not line:
+            return 0
+        glyphs = [self.glyph(c) for c in set(line)]
+        return max(g[4] for g in glyphs) - min(g[2] for g in glyphs)
+    
+    def exceeds(self, width: float, max_width: float, line) -> bool:
+        """
+        Проверить, шире ли строка max_width
+        
+        Если расчетная ширина попадает в пределы пикселя от границы,
+        перепроверяем через getbbox, чтобы перенос совпадал точно.
+        """
+        if abs(width - max_width) < 1:
+            bbox = self.font.getbbox(line() if callable(line) else line)
+            width = bbox[2] - bbox[0]
+        return width > max_width
+
+
+class TextLayout:
+    """Результат раскладки текста: шрифт, строки и их размеры"""
+    
+    def __init__(self, font, font_size: int, lines: tuple, line_widths: tuple, line_heights: tuple):
+        self.font = font
+        self.font_size = font_size
+        self.lines = lines
+        self.line_widths = line_widths
+        self.line_heights = line_heights
+        self.max_line_width = max(line_widths, default=0)
+
+
 class ImageProcessor:
     """Обработка изображений валентинок"""
     
@@ -13,6 +253,169 @@ class ImageProcessor:
         3: {"path": f"{TEMPLATES_PATH}/template3.png"},
     }
     
+    # Поддерживаемые форматы вывода: формат -> расширение файла
+    ENCODERS = {
+        "PNG": "png",
+        "JPEG": "jpg",
+        "WEBP": "webp",
+    }
+    
+    # Затемнённые шаблоны, общие для всех рендеров в процессе
+    template_cache = TemplateCache(max_bytes=TEMPLATE_CACHE_MAX_MB * 1024 * 1024)
+    
+    # Есть ли файл шрифта (проверяется один раз в load_manifest, а не при каждом рендере)
+    font_available = True
+    
+    # Переиспользовать холст между рендерами в одном потоке вместо копии шаблона
+    reuse_canvas = True
+    _local = threading.local()
+    
+    @staticmethod
+    def _canvas_for(base):
+        """Холст потока под размер шаблона (выделяется один раз и переиспользуется)"""
+        canvases = getattr(ImageProcessor._local, "canvases", None)
+        if canvases is None:
+            canvases = ImageProcessor._local.canvases = {}
+        key = (base.mode, base.size)
+        canvas = canvases.get(key)
+        if canvas is None:
+            canvas = canvases[key] = Image.new(base.mode, base.size)
+        return canvas
+    
+    @staticmethod
+    def load_manifest(manifest_path: str = TEMPLATES_MANIFEST) -> bool:
+        """
+        Загрузить манифест собранных шаблонов (см. build_templates.py)
+        
+        Заменяет TEMPLATES данными из манифеста: путь к затемнённым сырым пикселям,
+        область под текст и таблицу минимальных размеров шрифта по длине текста.
+        Если манифеста нет, остаются исходные PNG-шаблоны.
+        
+        Returns:
+            True, если манифест загружен
+        """
+        ImageProcessor.font_available = os.path.exists(FONTS_PATH)
+        
+        if not os.path.exists(manifest_path):
+            return False
+        
+        try:
+            with open(manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+        except Exception as e:
+            print(f"⚠️ Не удалось прочитать манифест шаблонов {manifest_path}: {e}")
+            return False
+        
+        base_dir = os.path.dirname(manifest_path)
+        
+        # Таблица размеров шрифта верна только для того шрифта, с которым собиралась
+        font_info = manifest.get("font", {})
+        font_matches = (
+            ImageProcessor.font_available
+            and os.path.abspath(font_info.get("path", "")) == os.path.abspath(FONTS_PATH)
+            and font_info.get("mtime") == os.stat(FONTS_PATH).st_mtime
+        )
+        
+        templates = {}
+        for entry in manifest["templates"]:
+            info = {
+                "path": entry["source"],
+                "source": entry["source"],
+                "text_area": tuple(entry["text_area"]),
+            }
+            
+            asset_path = os.path.join(base_dir, entry["asset"])
+            source_changed = (
+                os.path.exists(entry["source"])
+                and os.stat(entry["source"]).st_mtime != entry["source_mtime"]
+            )
+            if source_changed:
+                print(f"⚠️ Шаблон {entry['source']} изменился после сборки, используется исходный PNG")
+            elif os.path.exists(asset_path):
+                info["path"] = asset_path
+                info["source_mtime"] = entry["source_mtime"]
+                ImageProcessor.template_cache.raw_assets[asset_path] = (entry["mode"], tuple(entry["size"]))
+            
+            if font_matches and not source_changed:
+                info["min_font_sizes"] = entry["min_font_sizes"]
+                info["charset"] = frozenset(manifest["charset"])
+            
+            templates[entry["id"]] = info
+        
+        ImageProcessor.TEMPLATES = templates
+        ImageProcessor.layout_text.cache_clear()
+        return True
+    
+    @staticmethod
+    def default_text_area(img_width: int, img_height: int) -> tuple:
+        """Область под текст по умолчанию: без полей 50px по бокам, половина высоты по центру"""
+        top = img_height // 2 - (img_height // 2) // 2
+        return (50, top, img_width - 50, top + img_height // 2)
+    
+    @staticmethod
+    def text_area(template_id: int, img_width: int, img_height: int) -> tuple:
+        """Область под текст (x1, y1, x2, y2) для шаблона в координатах полного размера"""
+        info = ImageProcessor.TEMPLATES.get(template_id, {})
+        return info.get("text_area") or ImageProcessor.default_text_area(img_width, img_height)
+    
+    @staticmethod
+    def min_font_size(template_id: int, text: str) -> Optional[int]:
+        """
+        Размер шрифта, которым текст такой длины гарантированно помещается
+        
+        Берется из таблицы манифеста; None, если таблицы нет или в тексте есть
+        символы, для которых она не считалась.
+        """
+        info = ImageProcessor.TEMPLATES.get(template_id, {})
+        sizes = info.get("min_font_sizes")
+        if not sizes or len(text) >= len(sizes) or not info["charset"].issuperset(text):
+            return None
+        return sizes[len(text)]
+    
+    @staticmethod
+    def preload_templates():
+        """Заранее загрузить все шаблоны (и их уменьшенные копии для превью) в кэш"""
+        paths = [info["path"] for info in ImageProcessor.TEMPLATES.values()]
+        ImageProcessor.template_cache.preload(paths)
+        ImageProcessor.template_cache.preload(paths, PREVIEW_MAX_SIDE)
+    
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def get_font(size: int, font_path: str = FONTS_PATH):
+        """Объект шрифта нужного размера (один FreeType face на размер)"""
+        return ImageFont.truetype(font_path, size=size)
+    
+    @staticmethod
+    def encode_image(img, image_format: str = RENDER_FORMAT, quality: int = RENDER_QUALITY,
+                     compress_level: int = RENDER_PNG_COMPRESS_LEVEL) -> BytesIO:
+        """
+        Закодировать изображение в память
+        
+        Args:
+            img: PIL Image объект (RGB)
+            image_format: "PNG", "JPEG" или "WEBP"
+            quality: качество для JPEG/WEBP (1-100)
+            compress_level: уровень сжатия для PNG (0-9, 1 - быстро, 9 - компактно)
+        
+        Returns:
+            BytesIO с данными, позиция в начале, name = "valentine.<ext>"
+        """
+        image_format = image_format.upper()
+        if image_format not in ImageProcessor.ENCODERS:
+            raise ValueError(f"Неизвестный формат изображения: {image_format}")
+        
+        buffer = BytesIO()
+        if image_format == "PNG":
+            img.save(buffer, "PNG", compress_level=compress_level)
+        elif image_format == "JPEG":
+            img.save(buffer, "JPEG", quality=quality, subsampling=0 if quality >= 90 else 2)
+        else:
+            img.save(buffer, "WEBP", quality=quality, method=0)
+        
+        buffer.seek(0)
+        buffer.name = f"valentine.{ImageProcessor.ENCODERS[image_format]}"
+        return buffer
+    
     @staticmethod
     def darken_image(img, darkness_level=0.3):
         """
@@ -22,16 +425,16 @@ class ImageProcessor:
             img: PIL Image объект
             darkness_level: уровень затемнения (0-1), где 0 = оригинал, 1 = полностью черное
         """
-        # Создаем черный слой
-        dark_layer = Image.new('RGBA', img.size, (0, 0, 0, int(255 * darkness_level)))
+        # Наложение черного слоя с прозрачностью alpha на непрозрачную картинку -
+        # это умножение каждого канала на (255 - alpha) / 255, поэтому делаем его
+        # одной таблицей (LUT) прямо по RGB, без промежуточных RGBA-изображений
+        alpha = int(255 * darkness_level)
+        lut = [(v * (255 - alpha) + 127) // 255 for v in range(256)]
         
-        # Конвертируем исходное изображение в RGBA если нужно
-        if img.mode != 'RGBA':
-            img = img.convert('RGBA')
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
         
-        # Накладываем черный слой
-        result = Image.alpha_composite(img, dark_layer)
-        return result.convert('RGB')
+        return img.point(lut * 3)
     
     @staticmethod
     def blur_ellipse(draw, bbox, color, alpha=120, blur_radius=25):
@@ -76,6 +479,42 @@ class ImageProcessor:
                 fill=(*color, current_alpha)
             )
     
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def _soft_ellipse_base(alpha: int, steps: int, size: int = 1024):
+        """
+        Нормализованная маска размытого эллипса (считается один раз)
+        
+        Рисуем те же концентрические эллипсы, что и blur_ellipse, но на квадрате
+        фиксированного размера, и берем только альфа-канал.
+        """
+        canvas = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+        ImageProcessor.blur_ellipse(
+            ImageDraw.Draw(canvas),
+            [0, 0, size - 1, size - 1],
+            color=(0, 0, 0),
+            alpha=alpha,
+            blur_radius=steps
+        )
+        return canvas.getchannel('A')
+    
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def soft_ellipse_mask(width: int, height: int, alpha: int = 180, steps: int = 35):
+        """
+        Маска размытого эллипса под размер текстового блока
+        
+        Args:
+            width, height: размеры эллипса в пикселях
+            alpha: непрозрачность в центре (0-255)
+            steps: количество концентрических колец
+        
+        Returns:
+            изображение в режиме 'L' размером width x height
+        """
+        base = ImageProcessor._soft_ellipse_base(alpha, steps)
+        return base.resize((max(1, width), max(1, height)), Image.BILINEAR)
+    
     @staticmethod
     def smart_wrap_text(text, font, max_width, max_lines=4):
         """
@@ -90,31 +529,36 @@ class ImageProcessor:
         Returns:
             список строк текста
         """
+        metrics = FontMetrics.of(font)
         words = text.split()
         lines = []
         current_line = []
+        current_advance = 0
         
         for word in words:
-            # Пробуем добавить слово к текущей строке
-            test_line = ' '.join(current_line + [word])
-            
-            # Измеряем ширину тестовой строки
-            bbox = font.getbbox(test_line)
-            line_width = bbox[2] - bbox[0]
+            # Пробуем добавить слово к текущей строке: ширину считаем по таблице
+            # метрик, а не измеряя всю строку заново
+            last_word = current_line[-1] if current_line else ""
+            test_advance = metrics.join_advance(current_advance, last_word, word)
+            first_char = current_line[0][0] if current_line else word[0]
+            line_width = metrics.ink_width(test_advance, first_char, word[-1])
             
             # Если строка слишком длинная
-            if line_width > max_width:
+            if metrics.exceeds(line_width, max_width, lambda: ' '.join(current_line + [word])):
                 # Если текущая строка не пуста, добавляем её
                 if current_line:
                     lines.append(' '.join(current_line))
                     current_line = [word]
+                    current_advance = metrics.word_advance(word)
                 else:
                     # Если слово само по себе слишком длинное, добавляем его отдельно
                     lines.append(word)
                     current_line = []
+                    current_advance = 0
             else:
                 # Добавляем слово к строке
                 current_line.append(word)
+                current_advance = test_advance
         
         # Добавляем последнюю строку
         if current_line:
@@ -129,249 +573,499 @@ class ImageProcessor:
         return lines
     
     @staticmethod
-    def calculate_optimal_font_size(text, font_path, max_width, max_height, initial_size=60):
+    def _font_fits(text, font_path, font_size, max_width, max_height) -> bool:
+        """Проверить, помещается ли текст заданным размером шрифта"""
+        try:
+            font = ImageProcessor.get_font(font_size, font_path)
+        except:
+            font = ImageFont.load_default()
+        
+        metrics = FontMetrics.of(font)
+        
+        # Умно переносим текст с учетом размера шрифта
+        wrapped = ImageProcessor.smart_wrap_text(text, font, max_width - 40, max_lines=4)
+        
+        # Вычисляем общую высоту текста
+        total_height = 0
+        max_line_width = 0
+        
+        for line in wrapped:
+            try:
+                line_width = metrics.line_width(line)
+                line_height = metrics.line_height(line)
+                
+                max_line_width = max(max_line_width, line_width)
+                total_height += line_height + 10  # 10px промежуток между строками
+            except:
+                pass
+        
+        return max_line_width <= max_width - 40 and total_height <= max_height - 40
+    
+    @staticmethod
+    def calculate_optimal_font_size(text, font_path, max_width, max_height, initial_size=60,
+                                    min_size=None):
         """
         Вычислить оптимальный размер шрифта
         
+        Кандидаты - размеры с шагом 2 от initial_size вниз до 22. Сначала проверяется
+        initial_size, остальные - бинарным поиском: если текст помещается каким-то
+        размером, то помещается и любым меньшим.
+        
         Args:
             text: текст для измерения
             font_path: путь к файлу шрифта
             max_width: максимальная ширина
             max_height: максимальная высота
             initial_size: начальный размер
+            min_size: размер, которым текст точно помещается (из манифеста) -
+                      меньшие размеры не проверяются
         
         Returns:
-            оптимальный размер шрифта
+            оптимальный размер шрифта (min_size, если крупнее ничего не подошло)
         """
-        font_size = initial_size
+        sizes = list(range(initial_size, 20, -2))
+        if min_size is not None:
+            sizes = [size for size in sizes if size >= min_size] or [initial_size]
+            if len(sizes) == 1:
+                return sizes[0]
+        
+        # Обычно текст сразу помещается начальным размером - проверяем его первым
+        if sizes and ImageProcessor._font_fits(text, font_path, sizes[0], max_width, max_height):
+            return sizes[0]
+        
+        # Ищем первый (самый крупный) подходящий размер среди оставшихся
+        lo, hi = 1, len(sizes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ImageProcessor._font_fits(text, font_path, sizes[mid], max_width, max_height):
+                hi = mid
+            else:
+                lo = mid + 1
+        
+        if lo < len(sizes):
+            return sizes[lo]
+        # Крупнее ничего не поместилось: гарантированный размер из манифеста, иначе минимальный
+        return min_size if min_size is not None else 20
+    
+    @staticmethod
+    @lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+    def layout_text(template_id: int, text: str, img_width: int, img_height: int) -> "TextLayout":
+        """
+        Подобрать шрифт, перенести текст и измерить строки
+        
+        Результат запоминается в LRU по (шаблон, текст, размер картинки), поэтому
+        повторная отправка или смена шаблона туда-обратно не требует расчетов.
+        """
+        x1, y1, x2, y2 = ImageProcessor.text_area(template_id, img_width, img_height)
+        
+        try:
+            # Вычисляем оптимальный размер шрифта
+            font_size = ImageProcessor.calculate_optimal_font_size(
+                text,
+                FONTS_PATH,
+                x2 - x1,
+                y2 - y1,
+                initial_size=60,
+                min_size=ImageProcessor.min_font_size(template_id, text)
+            )
+            font = ImageProcessor.get_font(font_size)
+        except Exception as e:
+            print(f"⚠️ Ошибка загрузки шрифта: {e}")
+            font = ImageFont.load_default()
+            font_size = 30
+        
+        metrics = FontMetrics.of(font)
+        
+        # Умный перенос текста с учетом реальной ширины
+        lines = ImageProcessor.smart_wrap_text(text, font, x2 - x1, max_lines=4)
+        
+        # Размеры каждой строки для точного выравнивания
+        line_widths = tuple(round(metrics.line_width(line)) for line in lines)
+        line_heights = tuple(metrics.line_height(line) for line in lines)
         
-        while font_size > 20:
+        return TextLayout(font, font_size, tuple(lines), line_widths, line_heights)
+    
+    @staticmethod
+    def media_key(template_id: int, text: str, image_format: str = RENDER_FORMAT,
+                  quality: int = RENDER_QUALITY, preview: bool = False) -> str:
+        """
+        Хэш содержимого картинки, которую нарисует create_valentine с этими параметрами
+
+        Учитывает шаблон и шрифт (по времени изменения файлов), затемнение и
+        формат, поэтому после замены шаблона ключ меняется. По нему кэшируется
+        file_id Telegram (Database.get_file_id). Имя отправителя на картинку
+        не влияет и в ключ не входит.
+        """
+        info = ImageProcessor.TEMPLATES.get(template_id, {})
+        source = info.get("source", info.get("path"))
+        
+        def mtime(path):
             try:
-                font = ImageFont.truetype(font_path, size=font_size)
-            except:
-                font = ImageFont.load_default()
-            
-            # Умно переносим текст с учетом размера шрифта
-            wrapped = ImageProcessor.smart_wrap_text(text, font, max_width - 40, max_lines=4)
-            
-            # Вычисляем общую высоту текста
-            total_height = 0
-            max_line_width = 0
-            
-            for line in wrapped:
-                try:
-                    bbox = font.getbbox(line)
-                    line_width = bbox[2] - bbox[0]
-                    line_height = bbox[3] - bbox[1]
-                    
-                    max_line_width = max(max_line_width, line_width)
-                    total_height += line_height + 10  # 10px промежуток между строками
-                except:
-                    pass
-            
-            # Проверяем, подходит ли размер
-            if max_line_width <= max_width - 40 and total_height <= max_height - 40:
-                return font_size
-            
-            font_size -= 2
+                return os.stat(path).st_mtime
+            except (OSError, TypeError):
+                return None
         
-        return max(20, font_size)
+        if preview:
+            image_format, quality = "JPEG", PREVIEW_QUALITY
+        parts = [
+            template_id, source, mtime(source), FONTS_PATH, mtime(FONTS_PATH),
+            ImageProcessor.template_cache.darkness_level, text, image_format.upper(), quality,
+            PREVIEW_MAX_SIDE if preview else None,
+        ]
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
     
     @staticmethod
-    def create_valentine(template_id: int, text: str, sender_name: str = "Unknown") -> dict:
+    def _template_missing(template_id: int) -> dict:
+        """Результат create_valentine, если файла шаблона нет на диске"""
+        template_info = ImageProcessor.TEMPLATES[template_id]
+        template_path = template_info.get("source", template_info["path"])
+        return {
+            "success": False,
+            "path": None,
+            "buffer": None,
+            "error": f"Файл шаблона не найден: {template_path}",
+            "message": f"❌ Ошибка: Файл шаблона не найден!\n\n"
+                       f"📁 Ожидаемый путь: `{template_path}`\n\n"
+                       f"Пожалуйста, проверьте, что папка `templates` содержит файл `template{template_id}.png`"
+        }
+    
+    @staticmethod
+    def _drop_stale_asset(template_id: int):
         """
-        Создать послание с текстом на шаблоне
+        Если исходный PNG изменился после сборки манифеста - перейти на него
         
-        Returns:
-            {
-                "success": bool,
-                "path": str (путь к файлу),
-                "error": str (описание ошибки, если есть),
-                "message": str (сообщение для пользователя)
-            }
+        Собранный шаблон и таблица размеров шрифта больше не соответствуют
+        исходнику; дальше шаблон рисуется из PNG (и перезагружается кэшем по
+        mtime), пока шаблоны не пересобраны build_templates.py.
+        """
+        info = ImageProcessor.TEMPLATES[template_id]
+        if "source_mtime" not in info:
+            return
+        try:
+            changed = os.stat(info["source"]).st_mtime != info["source_mtime"]
+        except OSError:
+            return
+        if not changed:
+            return
+        
+        print(f"⚠️ Шаблон {info['source']} изменился после сборки, используется исходный PNG")
+        ImageProcessor.template_cache.raw_assets.pop(info["path"], None)
+        ImageProcessor.TEMPLATES[template_id] = {
+            "path": info["source"],
+            "source": info["source"],
+            "text_area": info["text_area"],
+        }
+        ImageProcessor.layout_text.cache_clear()
+    
+    @staticmethod
+    def check_assets(template_id: int) -> Optional[dict]:
+        """
+        Проверить шаблон и шрифт: словарь с ошибкой или None, если всё на месте
+        
+        Наличие файлов на диске здесь не проверяется: шрифт проверен при загрузке
+        манифеста, а отсутствие шаблона обнаружит кэш (FileNotFoundError).
+        Собранный шаблон, исходник которого изменился, заменяется исходным PNG.
         """
         if template_id not in ImageProcessor.TEMPLATES:
+            available = ", ".join(str(t) for t in sorted(ImageProcessor.TEMPLATES))
             return {
                 "success": False,
                 "path": None,
+                "buffer": None,
                 "error": f"Шаблон #{template_id} не найден",
-                "message": f"❌ Ошибка: Шаблон #{template_id} не существует. Доступны шаблоны: 1, 2, 3"
+                "message": f"❌ Ошибка: Шаблон #{template_id} не существует. Доступны шаблоны: {available}"
             }
         
-        template_info = ImageProcessor.TEMPLATES[template_id]
-        template_path = template_info["path"]
-        
-        # Проверяем существование шаблона
-        if not os.path.exists(template_path):
-            return {
-                "success": False,
-                "path": None,
-                "error": f"Файл шаблона не найден: {template_path}",
-                "message": f"❌ Ошибка: Файл шаблона не найден!\n\n"
-                           f"📁 Ожидаемый путь: `{template_path}`\n\n"
-                           f"Пожалуйста, проверьте, что папка `templates` содержит файл `template{template_id}.png`"
-            }
+        ImageProcessor._drop_stale_asset(template_id)
         
-        # Проверяем ��рифт
-        if not os.path.exists(FONTS_PATH):
+        # Проверяем шрифт
+        if not ImageProcessor.font_available:
             return {
                 "success": False,
                 "path": None,
+                "buffer": None,
                 "error": f"Шрифт не найден: {FONTS_PATH}",
                 "message": f"❌ Ошибка: Шрифт не найден!\n\n"
                            f"📁 Ожидаемый путь: `{FONTS_PATH}`\n\n"
                            f"Пожалуйста, добавьте файл `Involve.ttf` в папку `fonts`"
             }
         
-        try:
-            # Открываем шаблон
-            img = Image.open(template_path)
-            
-            # Затемняем изображение
-            img = ImageProcessor.darken_image(img, darkness_level=0.3)
-            
-            # Получаем размеры изображения
-            img_width, img_height = img.size
-            
-            # Загружаем шрифт
+        return None
+    
+    @staticmethod
+    def draw_valentine(base, template_id: int, text: str, full_size: Optional[tuple] = None,
+                       out=None):
+        """
+        Нарисовать текст с подложкой на копии затемнённого шаблона
+        
+        Args:
+            base: затемнённый шаблон (не изменяется)
+            template_id: номер шаблона
+            text: текст послания
+            full_size: размер исходного шаблона, если base - уменьшенная копия (превью);
+                       раскладка считается для полного размера и масштабируется
+            out: готовый холст того же размера: шаблон копируется в него, и рисование
+                 идет прямо в нем без выделения нового изображения
+        
+        Returns:
+            новое изображение RGB
+        """
+        if out is not None:
+            out.paste(base)
+            img = out
+        else:
+            img = base.copy()
+        
+        # Получаем размеры изображения (для превью - размеры исходного шаблона)
+        img_width, img_height = full_size or img.size
+        scale = img.width / img_width
+        
+        # Подбираем шрифт и раскладываем текст (результат берется из кэша, если уже считали)
+        layout = ImageProcessor.layout_text(template_id, text, img_width, img_height)
+        font = layout.font
+        if scale != 1:
             try:
-                # Вычисляем оптимальный размер шрифта
-                font_size = ImageProcessor.calculate_optimal_font_size(
-                    text, 
-                    FONTS_PATH, 
-                    img_width - 100, 
-                    img_height // 2,
-                    initial_size=60
-                )
-                font = ImageFont.truetype(FONTS_PATH, size=font_size)
+                font = ImageProcessor.get_font(max(1, round(layout.font_size * scale)))
             except Exception as e:
-                print(f"⚠️ Ошибка загрузки ш��ифта: {e}")
-                font = ImageFont.load_default()
-                font_size = 30
-            
-            # Умный перенос текста с учетом реальной ширины
-            wrapped_text = ImageProcessor.smart_wrap_text(text, font, img_width - 100, max_lines=4)
-            
-            # Временный draw для измерения текста
-            temp_img = Image.new('RGB', (img_width, img_height), (0, 0, 0))
-            temp_draw = ImageDraw.Draw(temp_img)
-            
-            # Вычисляем размеры каждой строки для точного выравнивания
-            line_heights = []
-            line_widths = []
-            max_line_width = 0
-            
-            for line in wrapped_text:
-                try:
-                    bbox = temp_draw.textbbox((0, 0), line, font=font)
-                    line_width = bbox[2] - bbox[0]
-                    line_height = bbox[3] - bbox[1]
-                    
-                    line_widths.append(line_width)
-                    line_heights.append(line_height)
-                    max_line_width = max(max_line_width, line_width)
-                except:
-                    line_widths.append(img_width - 100)
-                    line_heights.append(font_size)
-            
-            # Вычисляем общую высоту текстового блока
-            line_spacing = 15  # Промежуток между строками
-            total_text_height = sum(line_heights) + (len(wrapped_text) - 1) * line_spacing
-            
-            # Параметры эллипса подложки
-            padding_horizontal = 50
-            padding_vertical = 40
-            
-            # Размеры области под текст
-            text_width = max_line_width + padding_horizontal * 2
-            text_height = total_text_height + padding_vertical * 2
-            
-            # Центрируем эллипс по центру изображения
-            center_x = img_width // 2
-            center_y = img_height // 2
-            
-            # Координаты эллипса
-            ellipse_x1 = center_x - text_width // 2
-            ellipse_y1 = center_y - text_height // 2
-            ellipse_x2 = center_x + text_width // 2
-            ellipse_y2 = center_y + text_height // 2
-            
-            # Создаем слой для подложки
-            overlay = Image.new('RGBA', img.size, (0, 0, 0, 0))
-            overlay_draw = ImageDraw.Draw(overlay)
-            
-            # Рисуем размытый черный эллипс
-            ImageProcessor.blur_ellipse(
-                overlay_draw,
-                [ellipse_x1, ellipse_y1, ellipse_x2, ellipse_y2],
-                color=(0, 0, 0),  # Черный цвет
-                alpha=180,  # Прозрачность (чем выше, тем непрозрачнее)
-                blur_radius=35  # Радиус размытия
+                print(f"⚠️ Ошибка загрузки шрифта: {e}")
+        wrapped_text = layout.lines
+        line_widths = layout.line_widths
+        line_heights = layout.line_heights
+        max_line_width = layout.max_line_width
+        
+        # Вычисляем общую высоту текстового блока
+        line_spacing = 15  # Промежуток между строками
+        total_text_height = sum(line_heights) + (len(wrapped_text) - 1) * line_spacing
+        
+        # Параметры эллипса подложки
+        padding_horizontal = 50
+        padding_vertical = 40
+        
+        # Размеры области под текст
+        text_width = max_line_width + padding_horizontal * 2
+        text_height = total_text_height + padding_vertical * 2
+        
+        # Центрируем эллипс по центру области под текст
+        area_x1, area_y1, area_x2, area_y2 = ImageProcessor.text_area(template_id, img_width, img_height)
+        center_x = (area_x1 + area_x2) // 2
+        center_y = (area_y1 + area_y2) // 2
+        
+        # Координаты эллипса
+        ellipse_x1 = center_x - text_width // 2
+        ellipse_y1 = center_y - text_height // 2
+        ellipse_x2 = center_x + text_width // 2
+        ellipse_y2 = center_y + text_height // 2
+        
+        # Затемняем только область эллипса: черный цвет через заранее
+        # посчитанную маску размытого эллипса
+        if scale != 1:
+            ellipse_x1, ellipse_y1, ellipse_x2, ellipse_y2 = (
+                round(v * scale) for v in (ellipse_x1, ellipse_y1, ellipse_x2, ellipse_y2)
             )
+        backdrop_mask = ImageProcessor.soft_ellipse_mask(
+            ellipse_x2 - ellipse_x1 + 1,
+            ellipse_y2 - ellipse_y1 + 1,
+            alpha=180,  # Прозрачность (чем выше, тем непрозрачнее)
+            steps=35  # Количество колец размытия
+        )
+        img.paste((0, 0, 0), (ellipse_x1, ellipse_y1), backdrop_mask)
+        draw = ImageDraw.Draw(img)
+        
+        # Рисуем текст
+        text_color = (255, 255, 255)  # Белый цвет
+        
+        # Вычисляем начальную Y позицию для центрирования текста по вертикали
+        text_y_start = center_y - total_text_height // 2
+        
+        for idx, line in enumerate(wrapped_text):
+            # Центрируем каждую строку по горизонтали
+            line_width = line_widths[idx]
+            x_position = center_x - line_width // 2
             
-            # Накладываем overlay на основное изображение
-            img = Image.alpha_composite(img.convert('RGBA'), overlay).convert('RGB')
-            draw = ImageDraw.Draw(img)
-            
-            # Рисуем текст
-            text_color = (255, 255, 255)  # Белый цвет
-            
-            # Вычисляем начальную Y позицию для центрирования текста по вертикали
-            text_y_start = center_y - total_text_height // 2
-            
-            for idx, line in enumerate(wrapped_text):
-                # Центрируем каждую строку по горизонтали
-                line_width = line_widths[idx]
-                x_position = center_x - line_width // 2
-                
-                # Позиция по вертикали
-                y_position = text_y_start + sum(line_heights[:idx]) + idx * line_spacing
-                
-                # Рисуем текст без обводки
-                try:
-                    draw.text(
-                        (x_position, y_position),
-                        line,
-                        fill=text_color,
-                        font=font,
-                        anchor="lt"
-                    )
-                except Exception as e:
-                    print(f"⚠️ Ошибка рисования текста: {e}")
-            
-            # Создаем уникальное имя файла
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            safe_name = "".join(c if c.isalnum() else "_" for c in sender_name)[:20]
-            output_path = f"temp_valentine_{template_id}_{safe_name}_{timestamp}.png"
-            
-            # Сохраняем
-            img.save(output_path, "PNG", quality=95)
+            # Позиция по вертикали
+            y_position = text_y_start + sum(line_heights[:idx]) + idx * line_spacing
             
-            # Проверяем, что файл создан
-            if not os.path.exists(output_path):
-                raise Exception("Файл не был сохранен на диск")
+            if scale != 1:
+                x_position, y_position = round(x_position * scale), round(y_position * scale)
             
+            # Рисуем текст без обводки
+            try:
+                draw.text(
+                    (x_position, y_position),
+                    line,
+                    fill=text_color,
+                    font=font,
+                    anchor="lt"
+                )
+            except Exception as e:
+                print(f"⚠️ Ошибка рисования текста: {e}")
+        
+        return img
+    
+    @staticmethod
+    def default_format(image_format: Optional[str], in_memory: bool) -> str:
+        """Формат по умолчанию: RENDER_FORMAT для отправки из памяти, PNG для файлов"""
+        if image_format:
+            return image_format
+        return RENDER_FORMAT if in_memory else "PNG"
+    
+    @staticmethod
+    def _save_result(img, template_id: int, sender_name: str, in_memory: bool,
+                     image_format: str, quality: int) -> dict:
+        """Закодировать готовую картинку и собрать результат для create_valentine"""
+        # Кодируем картинку в память
+        buffer = ImageProcessor.encode_image(img, image_format, quality)
+        
+        if in_memory:
             return {
                 "success": True,
-                "path": output_path,
+                "path": None,
+                "buffer": buffer,
                 "error": None,
                 "message": "✅ Послание создано успешно!"
             }
         
+        # Создаем уникальное имя файла
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        safe_name = "".join(c if c.isalnum() else "_" for c in sender_name)[:20]
+        extension = ImageProcessor.ENCODERS[image_format.upper()]
+        output_path = f"temp_valentine_{template_id}_{safe_name}_{timestamp}.{extension}"
+        
+        # Сохраняем
+        with open(output_path, "wb") as f:
+            f.write(buffer.getbuffer())
+        
+        return {
+            "success": True,
+            "path": output_path,
+            "buffer": None,
+            "error": None,
+            "message": "✅ Послание создано успешно!"
+        }
+    
+    @staticmethod
+    def _failure_result(e: Exception) -> dict:
+        """Результат create_valentine при ошибке рендера"""
+        error_msg = str(e)
+        print(f"❌ Ошибка создания послания: {error_msg}")
+        import traceback
+        traceback.print_exc()
+        
+        return {
+            "success": False,
+            "path": None,
+            "buffer": None,
+            "error": error_msg,
+            "message": f"⚠️ Ошибка при создании послания:\n\n"
+                       f"`{error_msg}`\n\n"
+                       f"Попробуйте отправить текстовое послание или свяжитесь с администратором."
+        }
+    
+    @staticmethod
+    def create_valentine(template_id: int, text: str, sender_name: str = "Unknown",
+                         in_memory: bool = False, image_format: Optional[str] = None,
+                         quality: int = RENDER_QUALITY, preview: bool = False) -> dict:
+        """
+        Создать послание с текстом на шаблоне
+        
+        Args:
+            template_id: номер шаблона
+            text: текст послания
+            sender_name: имя отправителя (для имени файла)
+            in_memory: вернуть картинку в памяти ("buffer") вместо файла ("path")
+            image_format: "PNG", "JPEG" или "WEBP"; по умолчанию RENDER_FORMAT
+                          в памяти и PNG для файла (как раньше)
+            quality: качество для JPEG/WEBP
+            preview: быстрое превью для выбора шаблона - уменьшенный шаблон
+                     (PREVIEW_MAX_SIDE по длинной стороне) и JPEG с качеством PREVIEW_QUALITY
+        
+        Returns:
+            {
+                "success": bool,
+                "path": str (путь к файлу, если in_memory=False),
+                "buffer": BytesIO (готов к отправке в Telegram, если in_memory=True),
+                "error": str (описание ошибки, если есть),
+                "message": str (сообщение для пользователя)
+            }
+        """
+        error = ImageProcessor.check_assets(template_id)
+        if error:
+            return error
+        image_format = ImageProcessor.default_format(image_format, in_memory)
+        
+        try:
+            template_path = ImageProcessor.TEMPLATES[template_id]["path"]
+            
+            if preview:
+                # Рисуем на уменьшенной копии шаблона и кодируем быстро
+                base, full_size = ImageProcessor.template_cache.get_with_size(template_path, PREVIEW_MAX_SIDE)
+                image_format, quality = "JPEG", PREVIEW_QUALITY
+            else:
+                # Берем затемнённый шаблон из кэша
+                base, full_size = ImageProcessor.template_cache.get_with_size(template_path)
+            
+            # Картинка сразу кодируется, поэтому рисуем на переиспользуемом холсте
+            canvas = ImageProcessor._canvas_for(base) if ImageProcessor.reuse_canvas else None
+            img = ImageProcessor.draw_valentine(base, template_id, text, full_size, out=canvas)
+            return ImageProcessor._save_result(img, template_id, sender_name, in_memory, image_format, quality)
+        
+        except FileNotFoundError:
+            return ImageProcessor._template_missing(template_id)
         except Exception as e:
-            error_msg = str(e)
-            print(f"❌ Ошибка создания послания: {error_msg}")
-            import traceback
-            traceback.print_exc()
+            return ImageProcessor._failure_result(e)
+    
+    @staticmethod
+    def render_many(items: Iterable[Dict], in_memory: bool = True, image_format: Optional[str] = None,
+                    quality: int = RENDER_QUALITY) -> Iterator[Tuple[int, Dict, dict]]:
+        """
+        Отрендерить пачку посланий (например, очередь получателя при первом /start)
+        
+        Задания группируются по шаблону: шаблон и шрифты берутся один раз на группу.
+        Результаты отдаются по мере готовности, то есть по группам, а не в порядке
+        items - порядок восстанавливается по индексу. Рендер идет в текущем потоке;
+        из async-обработчиков вызывайте render_service.render_many.
+        
+        Args:
+            items: словари с ключами "image_template" и "text"
+                   (как у Database.get_queued_valentines), опционально "sender_name"
+        
+        Yields:
+            (индекс в items, item, результат как у create_valentine)
+        """
+        image_format = ImageProcessor.default_format(image_format, in_memory)
+        groups = OrderedDict()
+        for index, item in enumerate(items):
+            groups.setdefault(item["image_template"], []).append((index, item))
+        
+        for template_id, group in groups.items():
+            error = ImageProcessor.check_assets(template_id)
+            if error:
+                for index, item in group:
+                    yield index, item, dict(error)
+                continue
             
-            return {
-                "success": False,
-                "path": None,
-                "error": error_msg,
-                "message": f"⚠️ Ошибка при создании послания:\n\n"
-                           f"`{error_msg}`\n\n"
-                           f"Попробуйте отправить текстовое послание или свяжитесь с администратором."
-            }
+            try:
+                base = ImageProcessor.template_cache.get(ImageProcessor.TEMPLATES[template_id]["path"])
+            except Exception as e:
+                if isinstance(e, FileNotFoundError):
+                    failure = ImageProcessor._template_missing(template_id)
+                else:
+                    failure = ImageProcessor._failure_result(e)
+                for index, item in group:
+                    yield index, item, dict(failure)
+                continue
+            
+            canvas = ImageProcessor._canvas_for(base) if ImageProcessor.reuse_canvas else None
+            for index, item in group:
+                try:
+                    img = ImageProcessor.draw_valentine(base, template_id, item["text"], out=canvas)
+                    result = ImageProcessor._save_result(
+                        img, template_id, item.get("sender_name", "Unknown"),
+                        in_memory, image_format, quality
+                    )
+                except Exception as e:
+                    result = ImageProcessor._failure_result(e)
+                yield index, item, result
 
 
 def format_sender_info(sender_id: int, sender_name: str, is_anonymous: bool) -> str:
@@ -385,4 +1079,8 @@ def truncate_text(text: str, max_length: int = MAX_TEXT_LENGTH) -> str:
     """Обрезать текст по максимальной длине"""
     if len(text) > max_length:
         return text[:max_length] + "..."
-    return text
\ No newline at end of file
+    return text
+
+
+# Манифест собранных шаблонов загружается один раз при импорте
+ImageProcessor.load_manifest()